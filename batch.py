@@ -0,0 +1,63 @@
+# python batch.py -p ./images/ --resize 800 --workers 4
+# python batch.py -p ./images/ --resize 800 --pipeline
+
+import json
+import logging
+import argparse
+from haze_removal import LAMBDA, T0, OMEGA, OPAQUE, GAMMA, PATCH_SIZE
+from haze_removal.batch import list_images, process_images
+from haze_removal.pipeline import pipeline_images
+
+parser = argparse.ArgumentParser(description="Haze removal of a folder of images")
+parser.add_argument("--path", "-p", type=str, help="Images folder or glob pattern", default=None)
+parser.add_argument("--patch_size", type=int, help="Patch size for dark channel extraction", default=PATCH_SIZE)
+parser.add_argument("--lambd", type=float, default=LAMBDA)
+parser.add_argument("--t0", type=float, default=T0)
+parser.add_argument("--omega", type=float, default=OMEGA)
+parser.add_argument("--opaque", type=float, default=OPAQUE)
+parser.add_argument("--gamma", type=float, default=GAMMA)
+parser.add_argument("--resize", type=int, help="Size of the largest side", default=1400)
+parser.add_argument("--save_folder", "-s", type=str, help="Folder to save haze-free images in", default="./results/")
+parser.add_argument("--soft_matting", "-m", action='store_true', help="Boolean to use soft matting")
+parser.add_argument("--guided_filtering", "-f", action='store_true', help="Boolean to use guided filtering")
+parser.add_argument("--color_guide", action='store_true', help="Boolean to use the color image as guide for guided filtering")
+parser.add_argument("--workers", "-w", type=int, help="Number of worker processes (defaults to the number of CPUs)", default=None)
+parser.add_argument("--pipeline", action='store_true', help="Boolean to overlap the decoding, haze removal and encoding of the images in an asyncio pipeline (--workers images dehazed concurrently)")
+parser.add_argument("--decoders", type=int, help="Number of images decoded concurrently with --pipeline", default=2)
+parser.add_argument("--encoders", type=int, help="Number of images encoded concurrently with --pipeline", default=2)
+parser.add_argument("--queue_size", type=int, help="Number of images waiting between two stages with --pipeline", default=2)
+parser.add_argument("--overwrite", action='store_true', help="Boolean to process again images that already have outputs")
+parser.add_argument("--report", type=str, help="JSON file to write the per-image and per-stage timings to", default=None)
+parser.add_argument("--quiet", "-q", action='store_true', help="Boolean to only log warnings")
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(message)s")
+
+
+if args.pipeline:
+    run = lambda paths, save_folder, **kwargs: pipeline_images(
+        paths, save_folder, compute_workers=args.workers or 1, decoders=args.decoders, encoders=args.encoders,
+        queue_size=args.queue_size, **kwargs,
+    )
+else:
+    run = lambda paths, save_folder, **kwargs: process_images(paths, save_folder, workers=args.workers, **kwargs)
+
+results = run(
+    list_images(args.path),
+    args.save_folder,
+    resize=args.resize,
+    gamma=args.gamma,
+    overwrite=args.overwrite,
+    patch_size=args.patch_size,
+    use_soft_matting=args.soft_matting,
+    guided_image_filtering=args.guided_filtering,
+    color_guide=args.color_guide,
+    lambd=args.lambd,
+    t0=args.t0,
+    omega=args.omega,
+    opaque=args.opaque,
+)
+
+if args.report is not None:
+    with open(args.report, 'w') as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,58 @@
+# From benchmarks folder:
+# python evaluate_cold_start.py --runs 3 --clear_cache
+# Measures the latency of new processes: import of haze_removal, then a first haze removal.
+# With --clear_cache, the first run compiles the numba kernels and fills the on-disk cache used by the next ones.
+
+import sys
+sys.path.append("../")
+
+import os
+import glob
+import json
+import argparse
+import subprocess
+
+
+PACKAGE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Run in a new interpreter for every measurement
+COLD_START = """
+import sys, json
+from time import perf_counter
+start = perf_counter()
+import numpy as np
+import haze_removal
+import_time = perf_counter() - start
+heavy_modules = [m for m in ("matplotlib", "skimage", "tqdm") if m in sys.modules]
+image = np.random.default_rng(0).random(({h}, {w}, 3))
+start = perf_counter()
+haze_removal.HazeRemover(image, use_soft_matting={soft_matting}, guided_image_filtering={guided_filtering}, print_intermediate=False).remove_haze()
+print(json.dumps({{"import_time": import_time, "first_run_time": perf_counter() - start, "heavy_modules_imported": heavy_modules}}))
+"""
+
+
+parser = argparse.ArgumentParser(description="Measure the cold-start latency of haze_removal")
+parser.add_argument("--runs", type=int, help="Number of new processes to measure", default=3)
+parser.add_argument("--size", type=int, help="Size of the largest side of the random test image", default=256)
+parser.add_argument("--soft_matting", "-m", action='store_true', help="Boolean to use soft matting")
+parser.add_argument("--guided_filtering", "-f", action='store_true', help="Boolean to use guided filtering")
+parser.add_argument("--clear_cache", action='store_true', help="Boolean to delete the numba cache before the first run")
+parser.add_argument("--output", "-o", type=str, help="JSON file to write the measurements to", default=None)
+args = parser.parse_args()
+
+
+if args.clear_cache:
+    for path in glob.glob(os.path.join(PACKAGE_FOLDER, "haze_removal", "__pycache__", "*.nb[ic]")):
+        os.remove(path)
+
+code = COLD_START.format(h=args.size * 3 // 4, w=args.size, soft_matting=args.soft_matting, guided_filtering=args.guided_filtering)
+runs = []
+for run in range(args.runs):
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=PACKAGE_FOLDER, stderr=subprocess.DEVNULL)
+    runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+    print("Run {}: import {:.2f}s, first haze removal {:.2f}s, heavy modules imported: {}".format(
+        run + 1, runs[-1]["import_time"], runs[-1]["first_run_time"], runs[-1]["heavy_modules_imported"] or "none"))
+
+if args.output is not None:
+    with open(args.output, 'w') as f:
+        json.dump(runs, f, indent=2)
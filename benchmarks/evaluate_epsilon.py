@@ -5,7 +5,7 @@ import sys
 sys.path.append("../")
 
 import argparse
-from haze_removal import load_image, create_save_folder_and_get_file_info
+from haze_removal import ArrayCache, load_image, create_save_folder_and_get_file_info
 from haze_removal.benchmarks import evaluate_impact_of_epsilon
 
 
@@ -13,6 +13,7 @@ parser = argparse.ArgumentParser(description="Benchmark the parameter eps")
 parser.add_argument("--path", "-p", type=str, help="Image path", default=None)
 parser.add_argument("--resize", type=int, help="Size of the largest side", default=1400)
 parser.add_argument("--save_folder", "-s", type=str, help="Folder to save haze-free image in", default="./results/epsilon/")
+parser.add_argument("--cache_dir", type=str, help="Folder to cache the matting laplacians, guided filter coefficients and refined transmissions in", default=None)
 args = parser.parse_args()
 
 
@@ -22,4 +23,4 @@ image = load_image(args.path, args.resize, show_image=False)
 
 
 EPSILONS = [1e-5, 1e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 1e-1, 1, 10, 100]
-evaluate_impact_of_epsilon(EPSILONS, image, save_folder)
+evaluate_impact_of_epsilon(EPSILONS, image, save_folder, cache=None if args.cache_dir is None else ArrayCache(args.cache_dir))
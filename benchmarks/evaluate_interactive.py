@@ -0,0 +1,59 @@
+# From benchmarks folder:
+# python evaluate_interactive.py -p path/to/image --resize 600
+# Checks that InteractiveSession.full_resolution gives the result of HazeRemover for the committed parameters,
+# and times parameter tweaks on the preview against full haze removals.
+# Exits with an error if a committed result differs from HazeRemover.
+
+import sys
+sys.path.append("../")
+
+import argparse
+import numpy as np
+from time import perf_counter
+from haze_removal import HazeRemover, InteractiveSession, load_image, GAMMA
+
+
+parser = argparse.ArgumentParser(description="Check the interactive session against HazeRemover")
+parser.add_argument("--path", "-p", type=str, help="Image path", default=None)
+parser.add_argument("--resize", type=int, help="Size of the largest side", default=600)
+parser.add_argument("--preview_size", type=int, help="Size of the largest side of the previews", default=256)
+parser.add_argument("--tolerance", type=float, help="Maximal absolute difference between the outputs", default=1e-12)
+args = parser.parse_args()
+
+
+image = load_image(args.path, args.resize, show_image=False)
+session = InteractiveSession(image, preview_size=args.preview_size, use_soft_matting=False, guided_image_filtering=True)
+h, w = image.shape[:2]
+roi = (h // 4, 3 * h // 4, w // 4, 3 * w // 4)
+
+# Successive commits, each checked against a full HazeRemover run with the parameters of the session
+COMMITS = [
+    {},
+    {"omega": 0.8, "t0": 0.2},
+    {"atmospheric_light": [0.7, 0.7, 0.7]},
+    {"atmospheric_light": None, "pyramid_size": args.resize // 3},
+    {"gamma": 0.8, "gamma_lut_size": 256},
+    {"pyramid_size": None, "use_soft_matting": True, "guided_image_filtering": False},
+]
+
+failures = []
+for parameters in COMMITS:
+    start = perf_counter()
+    session.preview(roi, **parameters)
+    preview_time = perf_counter() - start
+    session.commit()
+
+    start = perf_counter()
+    radiance, transmission, atmospheric_light = session.full_resolution()
+    commit_time = perf_counter() - start
+
+    haze_remover_parameters = {k: v for k, v in session.committed.items() if k != "gamma"}
+    expected = HazeRemover(image, **haze_remover_parameters).remove_haze(session.committed.get("gamma", GAMMA))
+    difference = max(np.max(np.abs(np.asarray(a) - np.asarray(b))) for a, b in zip((radiance, transmission, atmospheric_light), expected))
+    print("{:<60} preview {:.3f}s, full resolution {:.3f}s, difference with HazeRemover {:.1e}".format(
+        str(parameters), preview_time, commit_time, difference))
+    if difference > args.tolerance:
+        failures.append(parameters)
+
+if failures:
+    sys.exit(f"Committed results differing from HazeRemover: {failures}")
@@ -0,0 +1,49 @@
+# From benchmarks folder:
+# python evaluate_laplacian.py --size 512 --r 1
+# Compares the compact matting laplacian (exact entries, int32 indices, optional upper triangle) with the padded
+# layout of _laplacian_internals_gather: time, memory and largest difference between the matrices.
+# Exits with an error if the compact laplacian differs from the padded one.
+
+import sys
+sys.path.append("../")
+
+import argparse
+import numpy as np
+from time import perf_counter
+from haze_removal.laplacian import (
+    compute_laplacian, compute_compact_laplacian, symmetric_from_upper, sparse_nbytes, legacy_laplacian_nbytes,
+)
+
+
+parser = argparse.ArgumentParser(description="Compare the compact matting laplacian with the padded one")
+parser.add_argument("--size", type=int, help="Size of the largest side of the random test image", default=512)
+parser.add_argument("--r", type=int, help="Radius of the laplacian windows", default=1)
+parser.add_argument("--tolerance", type=float, help="Maximal relative difference between the matrices", default=1e-10)
+args = parser.parse_args()
+
+
+def run(function, *inputs, **kwargs):
+    function(np.ascontiguousarray(inputs[0][:32, :32]), *inputs[1:], **kwargs)  # compilation
+    start = perf_counter()
+    matrix = function(*inputs, **kwargs)
+    return matrix, perf_counter() - start
+
+
+image = np.random.default_rng(0).random((args.size, args.size * 4 // 3, 3))
+padded, padded_time = run(compute_laplacian, image, 1e-4, args.r, compact=False)
+legacy_nbytes = legacy_laplacian_nbytes(image.shape, args.r, image.dtype)
+print("{:<10} {:.3f}s, {:>12} entries, {:.1f} MB allocated by the kernel".format("padded", padded_time, padded.nnz, legacy_nbytes / 1e6))
+
+failures = []
+for name, upper in (("compact", False), ("upper", True)):
+    matrix, time = run(compute_compact_laplacian, image, 1e-4, args.r, upper=upper)
+    nbytes = sparse_nbytes(matrix)
+    full = symmetric_from_upper(matrix) if upper else matrix
+    difference = abs(full - padded).max() / abs(padded).max()
+    print("{:<10} {:.3f}s, {:>12} entries, {:.1f} MB ({:.1f} MB saved, {} indices), relative difference {:.1e}".format(
+        name, time, matrix.nnz, nbytes / 1e6, (legacy_nbytes - nbytes) / 1e6, matrix.indices.dtype, difference))
+    if difference > args.tolerance:
+        failures.append(name)
+
+if failures:
+    sys.exit(f"Compact laplacians differing from the padded one: {failures}")
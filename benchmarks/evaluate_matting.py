@@ -5,7 +5,7 @@ import sys
 sys.path.append("../")
 
 import argparse
-from haze_removal import load_image, create_save_folder_and_get_file_info
+from haze_removal import ArrayCache, load_image, create_save_folder_and_get_file_info
 from haze_removal.benchmarks import evaluate_impact_of_matting_methods
 
 
@@ -13,6 +13,7 @@ parser = argparse.ArgumentParser(description="Benchmark the matting method")
 parser.add_argument("--path", "-p", type=str, help="Image path", default=None)
 parser.add_argument("--resize", type=int, help="Size of the largest side", default=1400)
 parser.add_argument("--save_folder", "-s", type=str, help="Folder to save haze-free image in", default="./results/matting/")
+parser.add_argument("--cache_dir", type=str, help="Folder to cache the matting laplacians, guided filter coefficients and refined transmissions in", default=None)
 args = parser.parse_args()
 
 
@@ -21,4 +22,4 @@ _, _, save_folder = create_save_folder_and_get_file_info(args.path, args.save_fo
 image = load_image(args.path, args.resize, show_image=False)
 
 
-evaluate_impact_of_matting_methods(image, save_folder)
+evaluate_impact_of_matting_methods(image, save_folder, cache=None if args.cache_dir is None else ArrayCache(args.cache_dir))
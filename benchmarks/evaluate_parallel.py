@@ -0,0 +1,102 @@
+# From benchmarks folder:
+# python evaluate_parallel.py --size 512 --num_threads 4
+# Compares the parallel numba kernels with their serial versions (same results, speedup).
+# Exits with an error if a parallel kernel differs from its serial version.
+
+import sys
+sys.path.append("../")
+
+import argparse
+import numba
+import numpy as np
+from time import perf_counter
+from haze_removal.box_filter import _box_sum_axis0
+from haze_removal.dark_channel import _min_filter_axis0, _min_filter_axis1, _min_filter_axis1_stack
+from haze_removal.guided_filter import _compute_guided_filter_grey, _compute_guided_filter_color
+from haze_removal.laplacian import _laplacian_internals, _laplacian_internals_gather
+from haze_removal.radiance import _recover_radiance, gamma_lut
+
+
+parser = argparse.ArgumentParser(description="Compare the parallel numba kernels with the serial ones")
+parser.add_argument("--size", type=int, help="Size of the largest side of the random test image", default=512)
+parser.add_argument("--num_threads", type=int, help="Number of threads of the parallel kernels", default=numba.config.NUMBA_NUM_THREADS)
+parser.add_argument("--tolerance", type=float, help="Maximal relative difference between the kernels", default=1e-10)
+args = parser.parse_args()
+
+
+def serial(kernel):
+    # Same kernel compiled without parallel=True: prange loops run as plain range loops
+    return numba.njit(kernel.py_func)
+
+
+def run(function, *inputs):
+    function(*(np.ascontiguousarray(x[:32, :32]) if isinstance(x, np.ndarray) and x.ndim > 1 else x for x in inputs))  # compilation
+    start = perf_counter()
+    outputs = function(*inputs)
+    return outputs if isinstance(outputs, tuple) else (outputs,), perf_counter() - start
+
+
+def min_filter(kernel_axis1, kernel_axis0):
+    def apply(img, size):
+        out = np.empty_like(img)
+        kernel_axis1(img, size, out)
+        kernel_axis0(out, size, out)
+        return out
+    return apply
+
+
+def min_filter_stack(kernel_axis1, kernel_axis0):
+    def apply(img, size):
+        h, w, k = img.shape
+        out = np.empty_like(img)
+        kernel_axis1(img, size, out)
+        kernel_axis0(out.reshape(h, w * k), size, out.reshape(h, w * k))
+        return out
+    return apply
+
+
+def box_sum(kernel):
+    def apply(img, r):
+        out = np.empty_like(img)
+        kernel(img, r, out)
+        return out
+    return apply
+
+
+def radiance(kernel):
+    def apply(image, transmission, atmospheric_light, t0, gamma, lut):
+        out = np.empty_like(image)
+        clipped = kernel(image, transmission, atmospheric_light, t0, gamma, lut, out)
+        return out, np.array(clipped, dtype=np.float64)
+    return apply
+
+
+rng = np.random.default_rng(0)
+h, w = args.size * 3 // 4, args.size
+image = rng.random((h, w, 3))
+grey = image[:, :, 0].copy()
+numba.set_num_threads(args.num_threads)
+
+KERNELS = {
+    "box_sum": (box_sum(serial(_box_sum_axis0)), box_sum(_box_sum_axis0), (image, 20)),
+    "min_filter": (min_filter(serial(_min_filter_axis1), serial(_min_filter_axis0)), min_filter(_min_filter_axis1, _min_filter_axis0), (grey, 15)),
+    "min_filter_stack": (min_filter_stack(serial(_min_filter_axis1_stack), serial(_min_filter_axis0)), min_filter_stack(_min_filter_axis1_stack, _min_filter_axis0), (image, 15)),
+    "guided_filter_grey": (serial(_compute_guided_filter_grey), _compute_guided_filter_grey, (grey, grey, 20, 1e-3)),
+    "guided_filter_color": (serial(_compute_guided_filter_color), _compute_guided_filter_color, (grey, image, 20, 1e-3)),
+    # The serial laplacian scatters the contributions of each window, the parallel one gathers them per row
+    "laplacian": (_laplacian_internals, _laplacian_internals_gather, (image, 1e-4, 1)),
+    "radiance": (radiance(serial(_recover_radiance)), radiance(_recover_radiance), (image, grey, np.full(3, 0.9), 0.1, 0.8, gamma_lut(0.8))),
+}
+
+failures = []
+for name, (serial_kernel, parallel_kernel, inputs) in KERNELS.items():
+    serial_outputs, serial_time = run(serial_kernel, *inputs)
+    parallel_outputs, parallel_time = run(parallel_kernel, *inputs)
+    difference = max(np.max(np.abs(s - p)) / max(np.max(np.abs(s)), 1e-300) for s, p in zip(serial_outputs, parallel_outputs))
+    print("{:<22} serial {:.3f}s, parallel {:.3f}s ({} threads), speedup {:.2f}, relative difference {:.1e}".format(
+        name, serial_time, parallel_time, args.num_threads, serial_time / parallel_time, difference))
+    if difference > args.tolerance:
+        failures.append(name)
+
+if failures:
+    sys.exit(f"Parallel kernels differing from the serial ones: {failures}")
@@ -0,0 +1,40 @@
+# From benchmarks folder:
+# python evaluate_performance.py --sizes 256 512 1024 -o ../results/performance.json
+# python evaluate_performance.py --sizes 256 512 1024 --baseline ../results/performance.json
+# Exits with an error if a case is slower than in the baseline report by more than --max_slowdown.
+
+import sys
+sys.path.append("../")
+
+import os
+import argparse
+from haze_removal.batch import list_images
+from haze_removal.performance import PERFORMANCE_METHODS, run_performance_benchmark, compare_reports, save_report, load_report
+
+
+parser = argparse.ArgumentParser(description="Measure the speed and memory of the haze removal methods")
+parser.add_argument("--images", "-p", type=str, help="Images folder or glob pattern, in addition to a synthetic image", default=None)
+parser.add_argument("--sizes", type=int, nargs="+", help="Sizes of the largest side", default=[256, 512, 1024])
+parser.add_argument("--methods", type=str, nargs="+", choices=list(PERFORMANCE_METHODS), default=list(PERFORMANCE_METHODS))
+parser.add_argument("--repeats", type=int, help="Number of warm runs after the cold one", default=3)
+parser.add_argument("--output", "-o", type=str, help="JSON file to write the report to", default=None)
+parser.add_argument("--baseline", type=str, help="JSON report to compare the warm times with", default=None)
+parser.add_argument("--max_slowdown", type=float, help="Relative slowdown against the baseline reported as a regression", default=0.1)
+args = parser.parse_args()
+
+
+images = {"synthetic": None}
+if args.images is not None:
+    images.update({os.path.basename(path): path for path in list_images(args.images)})
+
+report = run_performance_benchmark(images, args.sizes, args.methods, args.repeats)
+print("Scaling exponents (time ~ pixels ** k):", report["scaling_exponents"])
+if args.output is not None:
+    save_report(report, args.output)
+
+if args.baseline is not None:
+    regressions = compare_reports(report, load_report(args.baseline), args.max_slowdown)
+    for regression in regressions:
+        print("Regression: {image} {width}x{height} {method} {baseline_warm_time:.3f}s -> {warm_time:.3f}s".format(**regression))
+    if regressions:
+        sys.exit(f"{len(regressions)} performance regressions")
@@ -0,0 +1,23 @@
+# From benchmarks folder:
+# python evaluate_precision.py -p path/to/image --resize 1000
+# Exits with an error if the float32 pipeline drifts from the float64 one beyond FLOAT32_TOLERANCES.
+
+import sys
+sys.path.append("../")
+
+import argparse
+from haze_removal import load_image
+from haze_removal.benchmarks import evaluate_precision
+
+
+parser = argparse.ArgumentParser(description="Compare the float32 pipeline with the float64 one")
+parser.add_argument("--path", "-p", type=str, help="Image path", default=None)
+parser.add_argument("--resize", type=int, help="Size of the largest side", default=1000)
+args = parser.parse_args()
+
+
+image = load_image(args.path, args.resize, show_image=False)
+
+within_tolerances, _ = evaluate_precision(image)
+if not all(within_tolerances.values()):
+    sys.exit(f"float32 errors above tolerance for: {[m for m, ok in within_tolerances.items() if not ok]}")
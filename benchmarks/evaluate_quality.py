@@ -0,0 +1,44 @@
+# From benchmarks folder:
+# python evaluate_quality.py -p path/to/clean/image --resize 600 -o ../results/quality.json
+# Synthesizes haze on a clean image and scores every method, in float64 and float32, against the ground truth.
+
+import sys
+sys.path.append("../")
+
+import json
+import argparse
+import numpy as np
+from skimage.io import imread
+from skimage.transform import resize
+from haze_removal import load_image
+from haze_removal.benchmarks import MATTING_METHODS
+from haze_removal.quality import evaluate_quality, format_quality_table
+
+
+parser = argparse.ArgumentParser(description="Score the haze removal methods on synthetic haze")
+parser.add_argument("--path", "-p", type=str, help="Clean image path", default=None)
+parser.add_argument("--depth", type=str, help="Depth map (.npy or image), defaults to a depth increasing towards the top", default=None)
+parser.add_argument("--beta", type=float, help="Scattering coefficient of the haze", default=1.)
+parser.add_argument("--atmospheric_light", type=float, nargs=3, default=[0.9, 0.9, 0.9])
+parser.add_argument("--resize", type=int, help="Size of the largest side", default=600)
+parser.add_argument("--workers", "-w", type=int, help="Number of threads computing the metrics", default=None)
+parser.add_argument("--output", "-o", type=str, help="JSON file to write the scores to", default=None)
+args = parser.parse_args()
+
+
+clean = load_image(args.path, args.resize, show_image=False)
+depth = None
+if args.depth is not None:
+    depth = np.load(args.depth) if args.depth.endswith(".npy") else imread(args.depth, as_gray=True)
+    depth = resize(depth, clean.shape[:2])
+
+configurations = {}
+for method, kwargs in MATTING_METHODS.items():
+    configurations[method] = kwargs
+    configurations[f"{method}_float32"] = {**kwargs, "dtype": np.float32}
+
+results = evaluate_quality(clean, configurations, depth, args.beta, args.atmospheric_light, workers=args.workers)
+print(format_quality_table(results))
+if args.output is not None:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
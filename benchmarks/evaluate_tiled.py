@@ -0,0 +1,40 @@
+# From benchmarks folder:
+# python evaluate_tiled.py -p path/to/image --resize 700 --tile_size 160
+# Compares the tiled haze removal (default parameters, guided filtering) with the full image one.
+# Exits with an error if the tiled radiance or transmission differs from the full image one beyond the tolerance.
+
+import sys
+sys.path.append("../")
+
+import argparse
+import numpy as np
+from haze_removal import HazeRemover, TiledHazeRemover, load_image
+
+
+parser = argparse.ArgumentParser(description="Compare the tiled haze removal with the full image one")
+parser.add_argument("--path", "-p", type=str, help="Image path", default=None)
+parser.add_argument("--resize", type=int, help="Size of the largest side", default=700)
+parser.add_argument("--tile_size", type=int, help="Size of the tiles", default=160)
+parser.add_argument("--tolerance", type=float, help="Maximal absolute difference between the outputs", default=1e-8)
+args = parser.parse_args()
+
+
+image = load_image(args.path, args.resize, show_image=False)
+kwargs = {"use_soft_matting": False, "guided_image_filtering": True}
+
+tiled_radiance, tiled_transmission, atmospheric_light = TiledHazeRemover(image, tile_size=args.tile_size, **kwargs).remove_haze()
+# Tiles use the exact guided filter (see TiledHazeRemover), compared with the full image with the same atmospheric light
+failures = []
+for fast in (False, True):
+    radiance, transmission, _ = HazeRemover(
+        image, **kwargs, fast_guide_filter=fast, atmospheric_light=atmospheric_light, print_intermediate=False,
+    ).remove_haze()
+    radiance_difference = np.max(np.abs(tiled_radiance - radiance))
+    transmission_difference = np.max(np.abs(tiled_transmission - transmission))
+    print("full image, {:<22} radiance difference {:.1e}, transmission difference {:.1e}".format(
+        "fast guided filter:" if fast else "exact guided filter:", radiance_difference, transmission_difference))
+    if not fast and max(radiance_difference, transmission_difference) > args.tolerance:
+        failures.append("exact guided filter")
+
+if failures:
+    sys.exit(f"Tiled haze removal differing from the full image one: {failures}")
@@ -24,6 +24,7 @@ parser = argparse.ArgumentParser(description="Run all the evaluation scripts")
 parser.add_argument("--folder", "-f", type=str, help="Images folder")
 parser.add_argument("--resize", type=int, help="Size of the largest side", default=1400)
 parser.add_argument("--save_folder", "-s", type=str, help="Folder to save haze-free image in", default="./results/")
+parser.add_argument("--cache_dir", type=str, help="Folder to cache the matting laplacians, guided filter coefficients and refined transmissions in", default=None)
 args = parser.parse_args()
 
 
@@ -37,4 +38,4 @@ for line in tqdm(files.splitlines()):
             "-p", "../images/" + file_name,
             "-s", f"../results/{subfolder}/",
             "--resize", str(args.resize),
-        ])
+        ] + ([] if args.cache_dir is None else ["--cache_dir", args.cache_dir]))
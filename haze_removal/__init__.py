@@ -1,3 +1,19 @@
+import os
+import numba
+
+# Worker processes (batch processing, benchmarks, server) are forked once the parallel kernels are loaded:
+# with TBB the parent then hangs at exit, and with GNU OpenMP the workers are terminated. The workqueue layer
+# is fork-safe (but does not support concurrent kernel launches from several threads), unless a layer is set explicitly
+if "NUMBA_THREADING_LAYER" not in os.environ and "NUMBA_THREADING_LAYER_PRIORITY" not in os.environ:
+    numba.config.THREADING_LAYER_PRIORITY = ["workqueue", "tbb", "omp"]
+
 from .haze_removal import HazeRemover
+from .tiled import TiledHazeRemover
+from .batched import BatchedHazeRemover
+from .video import VideoHazeRemover
+from .interactive import InteractiveSession
+from .cache import ArrayCache
+from .profiling import Profiler, Profile, StageProfile
+from .io import read_image, write_image, open_image_lazy, from_buffer
 from .utils import load_image, show_imgs, create_save_folder_and_get_file_info, get_save_extension
 from .constants import PATCH_SIZE, LAMBDA, T0, OMEGA, OPAQUE, GAMMA
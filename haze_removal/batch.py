@@ -0,0 +1,93 @@
+import logging
+import os
+import glob
+import numpy as np
+from time import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .constants import GAMMA
+from .haze_removal import HazeRemover
+from .io import open_image_lazy, resize_image, write_image, write_image_atomically
+from .utils import create_save_folder_and_get_file_info, get_save_extension
+
+
+logger = logging.getLogger(__name__)
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp")
+
+
+def list_images(path):
+    """Images of a folder, or images matching a glob pattern."""
+    paths = glob.glob(os.path.join(path, "*")) if os.path.isdir(path) else glob.glob(path)
+    return sorted(p for p in paths if os.path.splitext(p)[1].lower() in IMAGE_EXTENSIONS)
+
+
+def get_output_paths(path, save_folder, resize, haze_remover_kwargs):
+    name, file_extension, folder = create_save_folder_and_get_file_info(path, save_folder)
+    extension = get_save_extension(
+        haze_remover_kwargs.get("use_soft_matting", True),
+        haze_remover_kwargs.get("guided_image_filtering", False),
+        resize,
+        file_extension,
+    )
+    return {
+        "original": folder + f"{name}_original.{file_extension}",
+        "radiance": folder + f"{name}_radiance_{extension}",
+        "transmission": folder + f"{name}_transmission_{extension}",
+    }
+
+
+def warm_up(haze_remover_kwargs=None):
+    """
+    Runs the pipeline on a small image so that the numba kernels are compiled once per worker,
+    whose progress messages are silenced.
+    """
+    logging.getLogger("haze_removal").setLevel(logging.WARNING)
+    image = np.random.default_rng(0).random((64, 64, 3))
+    HazeRemover(image, **{**(haze_remover_kwargs or {}), "print_intermediate": False}).remove_haze()
+
+
+def process_image(path, save_folder, resize=1400, gamma=GAMMA, overwrite=False, haze_remover_kwargs=None):
+    haze_remover_kwargs = haze_remover_kwargs or {}
+    output_paths = get_output_paths(path, save_folder, resize, haze_remover_kwargs)
+    if not overwrite and all(os.path.exists(p) for p in output_paths.values()):
+        return {"path": path, "status": "skipped", "time": 0.}
+
+    start = time()
+    # The image is resized in its integer type, and only converted to floats by HazeRemover
+    image = resize_image(open_image_lazy(path), resize)
+    haze_remover = HazeRemover(image, **{**haze_remover_kwargs, "print_intermediate": False})
+    radiance, transmission, _ = haze_remover.remove_haze(gamma)
+
+    write_image(output_paths["original"], image)
+    # The radiance is written last: its presence marks the image as processed, so it only appears once complete
+    write_image(output_paths["transmission"], transmission)
+    write_image_atomically(output_paths["radiance"], radiance)
+
+    return {"path": path, "status": "done", "time": time() - start, "stages": haze_remover.profile.wall_times()}
+
+
+def process_images(paths, save_folder, workers=None, resize=1400, gamma=GAMMA, overwrite=False, **haze_remover_kwargs):
+    """
+    Dehazes a list of images over a pool of worker processes, each compiling the kernels once.
+    Images whose outputs already exist are skipped unless overwrite is set, so an interrupted
+    batch can be resumed by running it again. Returns the status and timing of every image.
+    """
+    results = []
+    start = time()
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm_up, initargs=(haze_remover_kwargs,)) as executor:
+        futures = {
+            executor.submit(process_image, path, save_folder, resize, gamma, overwrite, haze_remover_kwargs): path
+            for path in paths
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                result = {"path": futures[future], "status": f"failed: {error}", "time": 0.}
+            results.append(result)
+            logger.info("[{}/{}] {} {} ({:2f}s)".format(len(results), len(paths), result["path"], result["status"], result["time"]))
+
+    logger.info("Took {:2f}s to process {} images".format(time() - start, len(paths)))
+    return results
@@ -0,0 +1,148 @@
+import logging
+import numpy as np
+from warnings import warn
+
+from .constants import PATCH_SIZE, OMEGA, T0, EPS_GF, OPAQUE
+from .dark_channel import dark_channel
+from .guided_filter import guided_filter_coefficients, combine_meanA_meanB_guide
+from .haze_removal import default_window_size, quadtree_atmospheric_light
+from .profiling import Profiler
+from .radiance import clip_unit
+from .utils import to_float_image
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedHazeRemover:
+    """
+    Haze removal of a stack of images of the same size (n, h, w, 3) in a single pipeline: every stage runs on the
+    whole stack with vectorized operations, instead of n pipelines of HazeRemover. The stack is stored as (h, w, n, 3),
+    the images being channels for the dark channel and box filters. Refinement is done by (fast) guided filtering,
+    or not at all; results are the ones of HazeRemover with box_filter=True for each image.
+    """
+    def __init__(self, images, patch_size=PATCH_SIZE, omega=OMEGA, t0=T0, eps_gf=EPS_GF, opaque=OPAQUE, window_size=None, guided_image_filtering=True, fast_guide_filter=True, color_guide=False, atmospheric_light=None, atmospheric_light_method="dark_channel", dtype=np.float64, profiler=None):
+        if images.ndim != 4:
+            raise ValueError(f"Expected a stack of images (n, h, w, 3), got an array of shape {images.shape}")
+        self.patch_size = patch_size
+        self.omega = omega
+        self.t0 = t0
+        self.eps_gf = eps_gf
+        self.opaque = opaque
+        self.window_size = window_size
+        self.guided_image_filtering = guided_image_filtering
+        self.fast_guide_filter = fast_guide_filter
+        self.color_guide = color_guide
+        self.atmospheric_light_method = atmospheric_light_method
+        # (n, 3) atmospheric light of each image
+        self.atmospheric_light = None if atmospheric_light is None else np.broadcast_to(atmospheric_light, (len(images), 3))
+
+        # Converted to floats in the (h, w, n, 3) layout in a single pass
+        n, h, w, c = images.shape
+        self.images = np.empty((h, w, n, c), dtype=dtype)
+        to_float_image(images.transpose(1, 2, 0, 3), dtype, out=self.images)
+        self.dtype = self.images.dtype
+        self.dark_channel = None
+        self.profiler = Profiler() if profiler is None else profiler
+
+    def __len__(self):
+        return self.images.shape[2]
+
+    def compute_dark_channel(self):
+        if self.dark_channel is None:
+            with self.profiler.stage("dark_channel"):
+                self.dark_channel = dark_channel(self.images, self.patch_size)
+        return self.dark_channel
+
+    def compute_atmospheric_light(self):
+        if self.atmospheric_light_method not in ("dark_channel", "quadtree"):
+            raise ValueError(f"Unknown atmospheric light method: {self.atmospheric_light_method}")
+
+        with self.profiler.stage("atmospheric_light", method=self.atmospheric_light_method):
+            h, w, n, c = self.images.shape
+            if self.atmospheric_light_method == "quadtree":
+                self.atmospheric_light = np.stack([quadtree_atmospheric_light(self.images[:, :, i]) for i in range(n)])
+                return
+
+            # Brightest pixel among the opaque fraction of highest dark channel values, in every image at once
+            dark_channel = self.compute_dark_channel().reshape((h * w, n))
+            k = max(1, int(self.opaque * h * w))
+            # (n, k) indices of the pixels of each image
+            brightest_dark_channel = np.argpartition(dark_channel.T, -k, axis=1)[:, -k:]
+            interest_zone = self.images.reshape((h * w, n, c))[brightest_dark_channel, np.arange(n)[:, None]]
+            brightest = np.argmax(np.sum(interest_zone, axis=2), axis=1)
+            self.atmospheric_light = interest_zone[np.arange(n), brightest]
+
+    def compute_transmission(self):
+        with self.profiler.stage("transmission"):
+            dark_channel_normalized = dark_channel(self.images / self.atmospheric_light, self.patch_size)
+            self.transmission = 1 - self.omega * dark_channel_normalized
+
+    def guided_filtering(self):
+        window_size = default_window_size(self.images.shape) if self.window_size is None else self.window_size
+        guide_images = self.images if self.color_guide else self.images[:, :, :, 0]
+
+        with self.profiler.stage("guided_filtering", window_size=window_size, fast=self.fast_guide_filter, color_guide=self.color_guide):
+            mean_A, mean_B = guided_filter_coefficients(
+                self.transmission, guide_images, window_size=window_size, eps=self.eps_gf,
+                color_guide=self.color_guide, fast=self.fast_guide_filter, box_filter=True,
+            )
+            if self.color_guide:
+                self.transmission = combine_meanA_meanB_guide(mean_A, guide_images, mean_B)
+            else:
+                self.transmission = mean_A * guide_images + mean_B
+
+    def refine_transmission(self):
+        method = "guided_filtering" if self.guided_image_filtering else "none"
+        with self.profiler.stage("refine_transmission", method=method):
+            if self.guided_image_filtering:
+                self.guided_filtering()
+
+            # The transmission is a new contiguous (h, w, n) array, clipped in place as a 2d array
+            h, w, n = self.transmission.shape
+            _, clipped = clip_unit(self.transmission.reshape((h, w * n)), out=self.transmission.reshape((h, w * n)))
+            if clipped:
+                warn("Clipping transmission")
+
+    def compute_radiance(self, gamma=1, out=None):
+        """(n, h, w, 3) radiance of the images, written to out if given."""
+        with self.profiler.stage("radiance", gamma=gamma) as stage:
+            # Computed in place in the (n, h, w, 3) output, from the (h, w, n, 3) stack
+            n, (h, w) = len(self), self.images.shape[:2]
+            self.radiance = np.empty((n, h, w, 3), dtype=self.dtype) if out is None else out
+            images = self.images.transpose(2, 0, 1, 3)
+            atmospheric_light = self.atmospheric_light[:, None, None]
+            np.subtract(images, atmospheric_light, out=self.radiance)
+            self.radiance /= np.maximum(self.transmission, self.t0).transpose(2, 0, 1)[..., None]
+            self.radiance += atmospheric_light
+            stage.info["clipped"] = bool((self.radiance < 0).any() or (self.radiance > 1).any())
+            if stage.info["clipped"]:
+                warn("Clipping radiance")
+                np.clip(self.radiance, 0, 1, out=self.radiance)
+            if gamma != 1:
+                np.power(self.radiance, gamma, out=self.radiance)
+
+    def remove_haze(self, correct_exposition=1, radiance_out=None):
+        """
+        Stacked radiances (n, h, w, 3), transmissions (n, h, w) and atmospheric lights (n, 3) of the images.
+        """
+        with self.profiler.stage("remove_haze", shape=self.images.shape, dtype=np.dtype(self.dtype).name) as stage:
+            if self.atmospheric_light is None:
+                logger.info("Computing atmospheric light...")
+                self.compute_atmospheric_light()
+
+            logger.info("Computing transmission...")
+            self.compute_transmission()
+
+            self.refine_transmission()
+
+            logger.info("Computing radiance...")
+            self.compute_radiance(correct_exposition, out=radiance_out)
+
+        logger.info("Took {:2f}s to perform haze removal of {} images".format(stage.wall_time, len(self)))
+
+        return self.radiance, np.ascontiguousarray(self.transmission.transpose(2, 0, 1)), self.atmospheric_light
+
+    @property
+    def profile(self):
+        return self.profiler.profile
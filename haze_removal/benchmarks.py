@@ -1,119 +1,116 @@
-import matplotlib.pyplot as plt
+import numpy as np
 from . import HazeRemover
-from .benchmarks_utils import EvaluationMetricManager, evaluate_haze_remover
+from .constants import GAMMA
+from .sweep import ParameterSweep
+from .benchmarks_utils import EvaluationMetricManager, evaluate_sweep
 
 
 # Parameter to limit the haze removal
-def evaluate_impact_of_omega(omegas, image, save_folder):
+def evaluate_impact_of_omega(omegas, image, save_folder, cache=None):
+    sweep = ParameterSweep(image, use_soft_matting=False, guided_image_filtering=True, cache=cache)
+    records = []
     for omega in omegas:
-        with EvaluationMetricManager("OMEGA", omega):
-            haze_remover = HazeRemover(
-                image,
-                use_soft_matting=False,
-                guided_image_filtering=True,
-                omega=omega
-            )
-            evaluate_haze_remover(haze_remover, save_folder, "OMEGA", omega)
+        with EvaluationMetricManager("OMEGA", omega, records=records):
+            evaluate_sweep(sweep, save_folder, "OMEGA", omega, omega=omega)
+    return records
 
 
 # Parameter to threshold minimal values of transmission map when computing radiance
-def evaluate_impact_of_t0(t0s, image, save_folder):
+def evaluate_impact_of_t0(t0s, image, save_folder, cache=None):
+    sweep = ParameterSweep(image, use_soft_matting=False, guided_image_filtering=True, cache=cache)
+    records = []
     for t0 in t0s:
-        with EvaluationMetricManager("T0", t0):
-            haze_remover = HazeRemover(
-                image,
-                use_soft_matting=False,
-                guided_image_filtering=True,
-                t0=t0
-            )
-            evaluate_haze_remover(haze_remover, save_folder, "t0", t0)
+        with EvaluationMetricManager("T0", t0, records=records):
+            evaluate_sweep(sweep, save_folder, "t0", t0, t0=t0)
+    return records
 
 
 # Patch size to compute transmission
-def evaluate_impact_of_patch_size(patch_sizes, image, save_folder):
+def evaluate_impact_of_patch_size(patch_sizes, image, save_folder, cache=None):
+    sweep = ParameterSweep(image, use_soft_matting=False, guided_image_filtering=True, cache=cache)
+    records = []
     for patch_size in patch_sizes:
-        with EvaluationMetricManager("PATCH SIZE", patch_size):
-            haze_remover = HazeRemover(
-                image,
-                use_soft_matting=False,
-                guided_image_filtering=True,
-                patch_size=patch_size
-            )
-            evaluate_haze_remover(haze_remover, save_folder, "patch_size", patch_size)
+        with EvaluationMetricManager("PATCH SIZE", patch_size, records=records):
+            evaluate_sweep(sweep, save_folder, "patch_size", patch_size, patch_size=patch_size)
+    return records
 
 
 # Window size to compute transmission refinement with (fast) guided filtering
-def evaluate_impact_of_window_size(window_sizes, image, save_folder):
+def evaluate_impact_of_window_size(window_sizes, image, save_folder, cache=None):
+    sweep = ParameterSweep(image, use_soft_matting=False, guided_image_filtering=True, cache=cache)
+    records = []
     for window_size in window_sizes:
-        with EvaluationMetricManager("WINDOW SIZE", window_size):
-            haze_remover = HazeRemover(
-                image,
-                use_soft_matting=False,
-                guided_image_filtering=True,
-                window_size=window_size
-            )
-            evaluate_haze_remover(haze_remover, save_folder, "window_size", window_size)
+        with EvaluationMetricManager("WINDOW SIZE", window_size, records=records):
+            evaluate_sweep(sweep, save_folder, "window_size", window_size, window_size=window_size)
+    return records
 
 
 # Epsilon parameter to compute transmission refinement with (fast) guided filtering
-def evaluate_impact_of_epsilon(epsilons, image, save_folder):
+def evaluate_impact_of_epsilon(epsilons, image, save_folder, cache=None):
+    sweep = ParameterSweep(image, use_soft_matting=False, guided_image_filtering=True, cache=cache)
+    records = []
     for epsilon in epsilons:
-        with EvaluationMetricManager("EPSILON", epsilon):
-            haze_remover = HazeRemover(
-                image,
-                use_soft_matting=False,
-                guided_image_filtering=True,
-                eps=epsilon
-            )
-            evaluate_haze_remover(haze_remover, save_folder, "epsilon", epsilon)
+        with EvaluationMetricManager("EPSILON", epsilon, records=records):
+            evaluate_sweep(sweep, save_folder, "epsilon", epsilon, eps_gf=epsilon)
+    return records
 
 
 # Window size to compute transmission refinement with (fast) guided filtering
-def evaluate_impact_of_window_size_and_epsilon(window_sizes, epsilons, image, save_folder):
+def evaluate_impact_of_window_size_and_epsilon(window_sizes, epsilons, image, save_folder, cache=None):
+    sweep = ParameterSweep(image, use_soft_matting=False, guided_image_filtering=True, cache=cache)
+    records = []
     for window_size in window_sizes:
         for epsilon in epsilons:
-            with EvaluationMetricManager("WINDOW SIZE, EPSILON", str((window_size, epsilon))):
-                haze_remover = HazeRemover(
-                    image,
-                    use_soft_matting=False,
-                    guided_image_filtering=True,
-                    window_size=window_size
-                )
-                evaluate_haze_remover(haze_remover, save_folder, "window_size_epsilon", str((window_size, epsilon)))
+            with EvaluationMetricManager("WINDOW SIZE, EPSILON", str((window_size, epsilon)), records=records):
+                evaluate_sweep(sweep, save_folder, "window_size_epsilon", str((window_size, epsilon)), window_size=window_size, eps_gf=epsilon)
+    return records
 
 
 # Type of matting performed
-def evaluate_impact_of_matting_methods(image, save_folder):
-    with EvaluationMetricManager("Matting", "None"):
-        haze_remover = HazeRemover(
-            image,
-            use_soft_matting=False,
-            guided_image_filtering=False,
-        )
-        evaluate_haze_remover(haze_remover, save_folder, "matting", "none")
-
-    with EvaluationMetricManager("Matting", "Soft matting"):
-        haze_remover = HazeRemover(
-            image,
-            use_soft_matting=True,
-            guided_image_filtering=False,
-        )
-        evaluate_haze_remover(haze_remover, save_folder, "matting", "soft")
-
-    with EvaluationMetricManager("Matting", "Guided filtering"):
-        haze_remover = HazeRemover(
-            image,
-            use_soft_matting=False,
-            guided_image_filtering=True,
-            fast_guide_filter=False,
-        )
-        evaluate_haze_remover(haze_remover, save_folder, "matting", "guided")
-
-    with EvaluationMetricManager("Matting", "Fast guided filtering"):
-        haze_remover = HazeRemover(
-            image,
-            use_soft_matting=False,
-            guided_image_filtering=True,
-            fast_guide_filter=True,
-        )
-        evaluate_haze_remover(haze_remover, save_folder, "matting", "fast_guided")
+def evaluate_impact_of_matting_methods(image, save_folder, cache=None):
+    sweep = ParameterSweep(image, cache=cache)
+    records = []
+
+    with EvaluationMetricManager("Matting", "None", records=records):
+        evaluate_sweep(sweep, save_folder, "matting", "none", use_soft_matting=False, guided_image_filtering=False)
+
+    with EvaluationMetricManager("Matting", "Soft matting", records=records):
+        evaluate_sweep(sweep, save_folder, "matting", "soft", use_soft_matting=True, guided_image_filtering=False)
+
+    with EvaluationMetricManager("Matting", "Guided filtering", records=records):
+        evaluate_sweep(sweep, save_folder, "matting", "guided", use_soft_matting=False, guided_image_filtering=True, fast_guide_filter=False)
+
+    with EvaluationMetricManager("Matting", "Fast guided filtering", records=records):
+        evaluate_sweep(sweep, save_folder, "matting", "fast_guided", use_soft_matting=False, guided_image_filtering=True, fast_guide_filter=True)
+
+    return records
+
+
+# Maximal absolute differences of radiance and transmission between the float32 and float64 pipelines
+FLOAT32_TOLERANCES = {
+    "none": 1e-4,
+    "guided": 1e-4,
+    "fast_guided": 1e-4,
+    "color_guided": 1e-4,
+    "soft": 2e-2,
+}
+
+MATTING_METHODS = {
+    "none": dict(use_soft_matting=False, guided_image_filtering=False),
+    "guided": dict(use_soft_matting=False, guided_image_filtering=True, fast_guide_filter=False),
+    "fast_guided": dict(use_soft_matting=False, guided_image_filtering=True, fast_guide_filter=True),
+    "color_guided": dict(use_soft_matting=False, guided_image_filtering=True, fast_guide_filter=False, color_guide=True),
+    "soft": dict(use_soft_matting=True, guided_image_filtering=False),
+}
+
+
+# Precision of the computations (float32 against float64) for every matting method
+def evaluate_precision(image, dtype=np.float32, tolerances=FLOAT32_TOLERANCES):
+    errors = {}
+    for method, kwargs in MATTING_METHODS.items():
+        with EvaluationMetricManager("Precision", method):
+            radiance_64, transmission_64, _ = HazeRemover(image, dtype=np.float64, print_intermediate=False, **kwargs).remove_haze(GAMMA)
+            radiance, transmission, _ = HazeRemover(image, dtype=dtype, print_intermediate=False, **kwargs).remove_haze(GAMMA)
+            errors[method] = max(np.max(np.abs(radiance - radiance_64)), np.max(np.abs(transmission - transmission_64)))
+            print(f"Maximal absolute error: {errors[method]:.2e} (tolerance {tolerances[method]:.0e})")
+    return {method: error <= tolerances[method] for method, error in errors.items()}, errors
@@ -1,27 +1,43 @@
 import os
-import matplotlib.pyplot as plt
+from time import perf_counter, process_time
 from .constants import GAMMA
+from .io import write_image
 
 
 class EvaluationMetricManager:
-    def __init__(self, metric_name, metric_value):
+    # If records is a list, (metric_name, metric_value, wall_time, cpu_time) of the evaluation is appended to it
+    def __init__(self, metric_name, metric_value, records=None):
         self.metric_name = metric_name
         self.metric_value = metric_value
-        
+        self.records = records
+        self.wall_time = None
+        self.cpu_time = None
+
     def __enter__(self):
         print('\n', "=" * 30, '\n', f"Evaluating {self.metric_name} = {self.metric_value}")
-        
+        self.start = perf_counter(), process_time()
+        return self
+
     def __exit__(self, exc_t, exc_v, trace):
-        None
+        self.wall_time = perf_counter() - self.start[0]
+        self.cpu_time = process_time() - self.start[1]
+        if self.records is not None:
+            self.records.append((self.metric_name, self.metric_value, self.wall_time, self.cpu_time))
+        print("Took {:2f}s (CPU {:2f}s)".format(self.wall_time, self.cpu_time))
 
 
 def save_radiance_transmission(save_folder, radiance, transmission, image, metric_name, metric_value):
     if not os.path.exists(save_folder + "original.jpg"):
-        plt.imsave(save_folder + "original.jpg", image)
-    plt.imsave(save_folder + f"radiance_{metric_name}_{metric_value}.jpg", radiance)
-    plt.imsave(save_folder + f"transmission_{metric_name}_{metric_value}.jpg", transmission, cmap='gray')
+        write_image(save_folder + "original.jpg", image)
+    write_image(save_folder + f"radiance_{metric_name}_{metric_value}.jpg", radiance)
+    write_image(save_folder + f"transmission_{metric_name}_{metric_value}.jpg", transmission)
 
 
 def evaluate_haze_remover(haze_remover, save_folder, metric_name, metric_value, gamma=GAMMA):
     radiance, transmission, _ = haze_remover.remove_haze(gamma)
     save_radiance_transmission(save_folder, radiance, transmission, haze_remover.image, metric_name, metric_value)
+
+
+def evaluate_sweep(sweep, save_folder, metric_name, metric_value, gamma=GAMMA, **parameters):
+    radiance, transmission, _ = sweep.run(gamma=gamma, **parameters)
+    save_radiance_transmission(save_folder, radiance, transmission, sweep.image, metric_name, metric_value)
@@ -0,0 +1,69 @@
+import numpy as np
+from numba import njit, prange, float32, float64, int64
+
+
+# Columns summed by each thread
+_STRIPE = 64
+
+
+@njit([(t[:, :, :], int64, t[:, :, :]) for t in (float32, float64)], parallel=True, cache=True)
+def _box_sum_axis0(img, r, out):
+    """
+    Running sum of img over [x - r, x + r] along the first axis, cropped at the borders.
+    img and out are 3d arrays (h, w, k), the sums are accumulated in float64.
+    Stripes of columns are summed in parallel, each with its own accumulator.
+    """
+    h, w, k = img.shape
+    for s in prange((w + _STRIPE - 1) // _STRIPE):
+        y0, y1 = s * _STRIPE, min(w, (s + 1) * _STRIPE)
+        acc = np.zeros((y1 - y0, k))
+        for x in range(min(r + 1, h)):
+            for y in range(y0, y1):
+                for c in range(k):
+                    acc[y - y0, c] += img[x, y, c]
+
+        for x in range(h):
+            for y in range(y0, y1):
+                for c in range(k):
+                    out[x, y, c] = acc[y - y0, c]
+
+            x_add, x_remove = x + r + 1, x - r
+            for y in range(y0, y1):
+                for c in range(k):
+                    if x_add < h:
+                        acc[y - y0, c] += img[x_add, y, c]
+                    if x_remove >= 0:
+                        acc[y - y0, c] -= img[x_remove, y, c]
+
+
+def _window_counts(length, r):
+    positions = np.arange(length)
+    return np.minimum(length, positions + r + 1) - np.maximum(0, positions - r)
+
+
+def box_sum(img, r):
+    """
+    Sum of img over the (2r+1)x(2r+1) window around each pixel, cropped at the image borders.
+    Works on (h, w) and (h, w, ...) arrays (e.g. stacks of images) with a cost independent of r.
+    """
+    h, w = img.shape[:2]
+    img3d = img.reshape((h, w, -1))
+    tmp = np.empty(img3d.shape, dtype=img.dtype)
+    out = np.empty(img3d.shape, dtype=img.dtype)
+
+    _box_sum_axis0(img3d, r, tmp)
+    _box_sum_axis0(tmp.transpose(1, 0, 2), r, out.transpose(1, 0, 2))
+
+    return out.reshape(img.shape)
+
+
+def box_mean(img, window_size):
+    """
+    Mean of img over the window of size window_size around each pixel, cropped at the image borders.
+    Same result as np.mean(extract_subpart2d(img, x, y, (window_size - 1) // 2)) at every pixel.
+    """
+    r = max(0, (window_size - 1) // 2)
+    h, w = img.shape[:2]
+    counts = np.outer(_window_counts(h, r), _window_counts(w, r)).astype(img.dtype)
+    counts = counts.reshape(counts.shape + (1,) * (img.ndim - 2))
+    return box_sum(img, r) / counts
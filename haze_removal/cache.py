@@ -0,0 +1,96 @@
+import os
+import shutil
+import hashlib
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .constants import CACHE_DIR, CACHE_MAX_BYTES
+
+
+def hash_array(array):
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((array.dtype.str, array.shape)).encode())
+    digest.update(array.data)
+    return digest.hexdigest()
+
+
+class ArrayCache:
+    """
+    Content-addressed on-disk cache of arrays. An entry is a folder of .npy files, named after a hash of
+    the name of the computation, its input arrays and its parameters, and loaded back memory-mapped.
+    When the cache grows over max_bytes, the least recently used entries are evicted.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, name, inputs=(), **parameters):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(name.encode())
+        for array in inputs:
+            digest.update(hash_array(array).encode())
+        digest.update(repr(sorted(parameters.items())).encode())
+        return f"{name}-{digest.hexdigest()}"
+
+    def get(self, key):
+        folder = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(folder):
+            return None
+        os.utime(folder)
+        return {
+            file_name[:-4]: np.load(os.path.join(folder, file_name), mmap_mode='r')
+            for file_name in os.listdir(folder) if file_name.endswith(".npy")
+        }
+
+    def put(self, key, arrays):
+        folder = os.path.join(self.cache_dir, key)
+        tmp_folder = f"{folder}.tmp-{os.getpid()}"
+        os.makedirs(tmp_folder, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_folder, name + ".npy"), array)
+        try:
+            os.rename(tmp_folder, folder)
+        except OSError:
+            # Already written by another process
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+        self.evict()
+
+    def get_or_compute(self, name, compute, inputs=(), **parameters):
+        """Returns the dict of arrays computed by compute(), from the cache if it has already been computed."""
+        key = self.key(name, inputs, **parameters)
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = compute()
+            self.put(key, arrays)
+        return arrays
+
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir() and ".tmp-" not in entry.name:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def sparse_to_arrays(matrix):
+    return {"data": matrix.data, "indices": matrix.indices, "indptr": matrix.indptr, "shape": np.array(matrix.shape)}
+
+
+def arrays_to_sparse(arrays):
+    return csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(arrays["shape"]))
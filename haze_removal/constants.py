@@ -7,3 +7,11 @@ EPS_GF = 5e-3
 R = 1
 OPAQUE = 1e-3
 GAMMA = .6
+SOLVER = "jacobi"
+SOLVER_TOL = 1e-4
+SOLVER_MAXITER = 1000
+CACHE_DIR = "~/.cache/haze_removal"
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+PYRAMID_WINDOW_SIZE = 8
+PYRAMID_EPS = 1e-4
+PREVIEW_SIZE = 512
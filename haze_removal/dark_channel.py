@@ -0,0 +1,120 @@
+import numpy as np
+from numba import njit, prange, float32, float64, int64
+
+
+# van Herk/Gil-Werman erosion: the (virtually +inf padded) signal is cut in blocks of `size` values,
+# and the minimum over any window of `size` values is the minimum of a suffix minimum of one block
+# and a prefix minimum of the next one, hence 3 comparisons per value whatever the size.
+# Windows cover [x - size // 2, x + (size - 1) // 2], like scipy.ndimage.minimum_filter.
+
+# Columns filtered by each thread along the first axis
+_STRIPE = 64
+_SIGNATURES = [(t[:, :], int64, t[:, :]) for t in (float32, float64)]
+
+@njit(_SIGNATURES, parallel=True, cache=True)
+def _min_filter_axis1(img, size, out):
+    h, w = img.shape
+    offset = size // 2
+    n = ((w + 2 * (size - 1)) // size) * size
+
+    # Rows are filtered in parallel, each with its own buffers
+    for x in prange(h):
+        prefix = np.empty(n, dtype=img.dtype)
+        suffix = np.empty(n, dtype=img.dtype)
+        for p in range(n):
+            y = p - offset
+            value = img[x, y] if 0 <= y < w else np.inf
+            prefix[p] = value if p % size == 0 else min(prefix[p - 1], value)
+        for p in range(n - 1, -1, -1):
+            y = p - offset
+            value = img[x, y] if 0 <= y < w else np.inf
+            suffix[p] = value if p % size == size - 1 else min(suffix[p + 1], value)
+        for y in range(w):
+            out[x, y] = min(suffix[y], prefix[y + size - 1])
+
+
+@njit(_SIGNATURES, parallel=True, cache=True)
+def _min_filter_axis0(img, size, out):
+    h, w = img.shape
+    offset = size // 2
+    n = ((h + 2 * (size - 1)) // size) * size
+
+    # Columns are processed by stripes so that the inner loops run along contiguous memory,
+    # the stripes in parallel, each with its own buffers (out can be img: a stripe only reads its own columns)
+    for s in prange((w + _STRIPE - 1) // _STRIPE):
+        y0, y1 = s * _STRIPE, min(w, (s + 1) * _STRIPE)
+        prefix = np.empty((n, _STRIPE), dtype=img.dtype)
+        suffix = np.empty((n, _STRIPE), dtype=img.dtype)
+        for p in range(n):
+            x = p - offset
+            for y in range(y0, y1):
+                value = img[x, y] if 0 <= x < h else np.inf
+                prefix[p, y - y0] = value if p % size == 0 else min(prefix[p - 1, y - y0], value)
+        for p in range(n - 1, -1, -1):
+            x = p - offset
+            for y in range(y0, y1):
+                value = img[x, y] if 0 <= x < h else np.inf
+                suffix[p, y - y0] = value if p % size == size - 1 else min(suffix[p + 1, y - y0], value)
+        for x in range(h):
+            for y in range(y0, y1):
+                out[x, y] = min(suffix[x, y - y0], prefix[x + size - 1, y - y0])
+
+
+@njit([(t[:, :, :], int64, t[:, :, :]) for t in (float32, float64)], parallel=True, cache=True)
+def _min_filter_axis1_stack(img, size, out):
+    h, w, k = img.shape
+    offset = size // 2
+    n = ((w + 2 * (size - 1)) // size) * size
+
+    # Same as _min_filter_axis1 for a stack (h, w, k) of k arrays: rows are filtered in parallel,
+    # the inner loops running over the contiguous last axis
+    for x in prange(h):
+        prefix = np.empty((n, k), dtype=img.dtype)
+        suffix = np.empty((n, k), dtype=img.dtype)
+        for p in range(n):
+            y = p - offset
+            for c in range(k):
+                value = img[x, y, c] if 0 <= y < w else np.inf
+                prefix[p, c] = value if p % size == 0 else min(prefix[p - 1, c], value)
+        for p in range(n - 1, -1, -1):
+            y = p - offset
+            for c in range(k):
+                value = img[x, y, c] if 0 <= y < w else np.inf
+                suffix[p, c] = value if p % size == size - 1 else min(suffix[p + 1, c], value)
+        for y in range(w):
+            for c in range(k):
+                out[x, y, c] = min(suffix[y, c], prefix[y + size - 1, c])
+
+
+def min_filter(img, size, out=None):
+    """
+    Minimum of a 2d array over the size x size window around each pixel, in O(1) per pixel.
+    A 3d array (h, w, k) is a stack of k arrays along its last axis, filtered together.
+    out can be a preallocated array, or img itself to filter in place.
+    """
+    out = np.empty_like(img) if out is None else out
+    if size <= 1:
+        out[...] = img
+        return out
+    if img.ndim == 3:
+        h, w, k = img.shape
+        _min_filter_axis1_stack(img, size, out)
+        # Along the first axis, the stack is a 2d array of w * k columns (out is contiguous)
+        _min_filter_axis0(out.reshape(h, w * k), size, out.reshape(h, w * k))
+        return out
+    _min_filter_axis1(img, size, out)
+    _min_filter_axis0(out, size, out)
+    return out
+
+
+def dark_channel(img, size, out=None):
+    """
+    Dark channel of a (h, w, c) image: minimum over the channels, then over the size x size patch.
+    Same result as np.min(minimum_filter(img, size), axis=2), written in out if given.
+    A (h, w, n, c) stack of n images gives the (h, w, n) stack of their dark channels.
+    """
+    # Pairwise minimums of the channels, much faster than np.min over the short last axis
+    out = np.minimum(img[..., 0], img[..., 1], out=out)
+    for c in range(2, img.shape[-1]):
+        np.minimum(out, img[..., c], out=out)
+    return min_filter(out, size, out=out)
@@ -1,48 +1,65 @@
 import numpy as np
 import cv2
-from numba import jit
-from .constants import EPS_GF
+from numba import njit, prange, float32, float64, int64
+from .constants import EPS_GF, PYRAMID_WINDOW_SIZE, PYRAMID_EPS
+from .box_filter import box_mean
 
-@jit
+
+FLOAT_TYPES = (float32, float64)
+
+@njit([(t[:, :], int64, int64, int64) for t in FLOAT_TYPES], cache=True)
 def extract_subpart2d(img, x, y, padding):
     h, w = img.shape
     x_start, x_end = max(0, x - padding), min(h, x + padding + 1)
     y_start, y_end = max(0, y - padding), min(w, y + padding + 1)
     return img[x_start:x_end, y_start:y_end]
 
-@jit
+@njit([(t[:, :, :], int64, int64, int64) for t in FLOAT_TYPES], cache=True)
 def extract_subpart3d(img, x, y, padding):
     h, w = img.shape[:2]
     x_start, x_end = max(0, x - padding), min(h, x + padding + 1)
     y_start, y_end = max(0, y - padding), min(w, y + padding + 1)
     return img[x_start:x_end, y_start:y_end, :]
 
+def _resize(img, dsize, interpolation):
+    # cv2.resize handles at most 4 channels in general: the trailing axes of stacks of images are folded
+    # into channels, resized by groups of 4
+    if img.ndim == 2 or img.ndim == 3 and img.shape[2] <= 4:
+        return cv2.resize(img, dsize, interpolation=interpolation)
+    h, w = img.shape[:2]
+    channels = img.reshape((h, w, -1))
+    resized = np.empty((dsize[1], dsize[0], channels.shape[2]), dtype=img.dtype)
+    for i in range(0, channels.shape[2], 4):
+        resized[:, :, i:i + 4] = cv2.resize(channels[:, :, i:i + 4], dsize, interpolation=interpolation).reshape((dsize[1], dsize[0], -1))
+    return resized.reshape(resized.shape[:2] + img.shape[2:])
+
+
 def compute_fast_guided_filter(guided_filter_function, input, guide_image, scale_factor=4, window_size=40, eps=EPS_GF):
     hs_input, ws_input = input.shape[0] // scale_factor, input.shape[1] // scale_factor
     hs_guide, ws_guide = guide_image.shape[0] // scale_factor, guide_image.shape[1] // scale_factor
 
-    input_small = cv2.resize(input, (hs_input, ws_input), interpolation=cv2.INTER_AREA)
-    guide_image_small = cv2.resize(guide_image, (hs_guide, ws_guide), interpolation=cv2.INTER_AREA)
+    input_small = _resize(input, (hs_input, ws_input), interpolation=cv2.INTER_AREA)
+    guide_image_small = _resize(guide_image, (hs_guide, ws_guide), interpolation=cv2.INTER_AREA)
     window_size = window_size // scale_factor
 
     mean_A_small, mean_B_small = guided_filter_function(input_small, guide_image_small, window_size, eps)
 
     w_guide, h_guide = guide_image.shape[:2]
-    mean_A = cv2.resize(mean_A_small, (h_guide, w_guide), interpolation=cv2.INTER_LINEAR)
-    mean_B = cv2.resize(mean_B_small, (h_guide, w_guide), interpolation=cv2.INTER_LINEAR)
+    mean_A = _resize(mean_A_small, (h_guide, w_guide), interpolation=cv2.INTER_LINEAR)
+    mean_B = _resize(mean_B_small, (h_guide, w_guide), interpolation=cv2.INTER_LINEAR)
 
     return mean_A, mean_B
 
 
 # ========= USING GREY INPUT AS GUIDED IMAGE =================
-@jit
-def compute_guided_filter_grey(input, guide_image, window_size=40, eps=EPS_GF):
+@njit([(t[:, :], t[:, :], int64, float64) for t in FLOAT_TYPES], parallel=True, cache=True)
+def _compute_guided_filter_grey(input, guide_image, window_size, eps):
     A = np.zeros_like(guide_image)
     B = np.zeros_like(guide_image)
     padding = (window_size - 1) // 2
 
     h, w = input.shape[:2]
-    for x in range(h):
+    for x in prange(h):
         for y in range(w):
             patch_input = extract_subpart2d(input, x, y, padding)
             patch_guide = extract_subpart2d(guide_image, x, y, padding)
@@ -58,7 +75,7 @@ def compute_guided_filter_grey(input, guide_image, window_size=40, eps=EPS_GF):
     mean_A = np.zeros_like(A)
     mean_B = np.zeros_like(B)
 
-    for x in range(h):
+    for x in prange(h):
         for y in range(w):
             mean_A[x, y] = np.mean(extract_subpart2d(A, x, y, padding))
             mean_B[x, y] = np.mean(extract_subpart2d(B, x, y, padding))
@@ -66,26 +83,50 @@ def compute_guided_filter_grey(input, guide_image, window_size=40, eps=EPS_GF):
     return mean_A, mean_B
 
 
-@jit
-def guided_filter_grey(input, guide_image, window_size=40, eps=EPS_GF):
-    mean_A, mean_B = compute_guided_filter_grey(input, guide_image, window_size, eps)
+def compute_guided_filter_grey(input, guide_image, window_size=40, eps=EPS_GF):
+    return _compute_guided_filter_grey(input, guide_image, window_size, eps)
+
+
+def grey_guide_statistics(guide_image, window_size=40):
+    """Box mean and variance of a grey guide, the part of the guided filter that does not depend on the input."""
+    mean_guide = box_mean(guide_image, window_size)
+    var_guide = box_mean(guide_image * guide_image, window_size) - mean_guide * mean_guide
+    return mean_guide, var_guide
+
+
+def compute_guided_filter_grey_box(input, guide_image, window_size=40, eps=EPS_GF, guide_statistics=None):
+    # guide_statistics: grey_guide_statistics(guide_image, window_size) if already computed, e.g. for another input
+    mean_guide, var_guide = grey_guide_statistics(guide_image, window_size) if guide_statistics is None else guide_statistics
+    mean_input = box_mean(input, window_size)
+    cov_input_guide = box_mean(input * guide_image, window_size) - mean_guide * mean_input
+
+    A = cov_input_guide / (var_guide + eps)
+    B = mean_input - A * mean_guide
+
+    return box_mean(A, window_size), box_mean(B, window_size)
+
+
+def guided_filter_grey(input, guide_image, window_size=40, eps=EPS_GF, box_filter=True):
+    compute_function = compute_guided_filter_grey_box if box_filter else compute_guided_filter_grey
+    mean_A, mean_B = compute_function(input, guide_image, window_size, eps)
     return mean_A * guide_image + mean_B
 
 
-def fast_guided_filter_grey(input, guide_image, scale_factor=4, window_size=40, eps=EPS_GF):
-    mean_A, mean_B = compute_fast_guided_filter(compute_guided_filter_grey, input, guide_image, scale_factor, window_size, eps)
+def fast_guided_filter_grey(input, guide_image, scale_factor=4, window_size=40, eps=EPS_GF, box_filter=True):
+    compute_function = compute_guided_filter_grey_box if box_filter else compute_guided_filter_grey
+    mean_A, mean_B = compute_fast_guided_filter(compute_function, input, guide_image, scale_factor, window_size, eps)
     return mean_A * guide_image + mean_B
 
 
 # ========= USING COLORED INPUT AS GUIDED IMAGE =================
-@jit
-def compute_guided_filter_color(input, guide_image, window_size=30, eps=EPS_GF):
+@njit([(t[:, :], t[:, :, :], int64, float64) for t in FLOAT_TYPES], parallel=True, cache=True)
+def _compute_guided_filter_color(input, guide_image, window_size, eps):
     A = np.zeros_like(guide_image)
     B = np.zeros_like(input)
     padding = (window_size - 1) // 2
 
     h, w = input.shape
-    for x in range(h):
+    for x in prange(h):
         for y in range(w):
             patch_input = extract_subpart2d(input, x, y, padding)
             patch_guide = extract_subpart3d(guide_image, x, y, padding)
@@ -98,39 +139,120 @@ def compute_guided_filter_color(input, guide_image, window_size=30, eps=EPS_GF):
                 mean_patch_guide[i] = np.mean(patch_guide[:,:,i])
                 mean_patch_input_guide[i] = np.mean(patch_input * patch_guide[:,:,i])
             
-            var_patch_guide = np.var(patch_guide)
+            cov_patch_guide = np.zeros((3, 3))
+            for i in range(3):
+                for j in range(3):
+                    cov_patch_guide[i, j] = np.mean(patch_guide[:,:,i] * patch_guide[:,:,j]) - mean_patch_guide[i] * mean_patch_guide[j]
 
-            A[x, y, :] = np.dot(np.linalg.inv(var_patch_guide + eps * np.eye(3)), (mean_patch_input_guide - mean_patch_guide * mean_patch_input))
-            B[x, y] = mean_patch_input - np.dot(A[x, y, :], mean_patch_guide)
+            A[x, y, :] = np.dot(np.linalg.inv(cov_patch_guide + eps * np.eye(3)), (mean_patch_input_guide - mean_patch_guide * mean_patch_input))
+            B[x, y] = mean_patch_input - np.sum(A[x, y, :] * mean_patch_guide)
 
     mean_A = np.zeros_like(A)
     mean_B = np.zeros_like(B)
 
-    for x in range(h):
+    for x in prange(h):
         for y in range(w):
-            mean_A[x, y, :] = np.mean(extract_subpart3d(A, x, y, padding))
+            patch_A = extract_subpart3d(A, x, y, padding)
+            for i in range(3):
+                mean_A[x, y, i] = np.mean(patch_A[:,:,i])
             mean_B[x, y] = np.mean(extract_subpart2d(B, x, y, padding))
-    
+
     return mean_A, mean_B
 
 
-@jit
-def combine_meanA_meanB_guide(mean_A, guide_image, mean_B, input):
-    output = np.zeros_like(input)
-    h, w = input.shape
-    for x in range(h):
-        for y in range(w):
-            output[x, y] = np.dot(mean_A[x,y,:], guide_image[x,y,:]) + mean_B[x,y]
+def compute_guided_filter_color(input, guide_image, window_size=30, eps=EPS_GF):
+    return _compute_guided_filter_color(input, guide_image, window_size, eps)
+
+
+def combine_meanA_meanB_guide(mean_A, guide_image, mean_B, input=None):
+    return np.einsum('...k,...k->...', mean_A, guide_image) + mean_B
+
+
+def solve_symmetric_3x3(a00, a01, a02, a11, a12, a22, b0, b1, b2):
+    """
+    Closed-form (adjugate) solution of S x = b for fields of symmetric 3x3 matrices S,
+    given by their upper triangle. All arguments are arrays of the same shape.
+    """
+    m00 = a11 * a22 - a12 * a12
+    m01 = a02 * a12 - a01 * a22
+    m02 = a01 * a12 - a02 * a11
+    m11 = a00 * a22 - a02 * a02
+    m12 = a01 * a02 - a00 * a12
+    m22 = a00 * a11 - a01 * a01
+
+    inv_det = 1.0 / (a00 * m00 + a01 * m01 + a02 * m02)
+
+    x = np.empty(b0.shape + (3,), dtype=b0.dtype)
+    x[..., 0] = (m00 * b0 + m01 * b1 + m02 * b2) * inv_det
+    x[..., 1] = (m01 * b0 + m11 * b1 + m12 * b2) * inv_det
+    x[..., 2] = (m02 * b0 + m12 * b1 + m22 * b2) * inv_det
+    return x
+
+
+def color_guide_statistics(guide_image, window_size=30):
+    """Box mean and color covariances (dict of the pairs of channels i <= j) of a color guide, which do not depend on the input."""
+    mean_guide = box_mean(guide_image, window_size)
+    cov_guide = {}
+    for i in range(3):
+        for j in range(i, 3):
+            cov_guide[i, j] = box_mean(guide_image[..., i] * guide_image[..., j], window_size) - mean_guide[..., i] * mean_guide[..., j]
+    return mean_guide, cov_guide
 
-    return output
 
+def compute_guided_filter_color_box(input, guide_image, window_size=30, eps=EPS_GF, guide_statistics=None):
+    # input can also be a (h, w, n) stack guided by a (h, w, n, 3) stack of images
+    mean_guide, cov_guide = color_guide_statistics(guide_image, window_size) if guide_statistics is None else guide_statistics
+    mean_input = box_mean(input, window_size)
+    cov_input_guide = box_mean(input[..., None] * guide_image, window_size) - mean_guide * mean_input[..., None]
 
-@jit
-def guided_filter_color(input, guide_image, window_size=30, eps=EPS_GF):
-    mean_A, mean_B = compute_guided_filter_color(input, guide_image, window_size, eps)
+    A = solve_symmetric_3x3(
+        cov_guide[0, 0] + eps, cov_guide[0, 1], cov_guide[0, 2],
+        cov_guide[1, 1] + eps, cov_guide[1, 2],
+        cov_guide[2, 2] + eps,
+        cov_input_guide[..., 0], cov_input_guide[..., 1], cov_input_guide[..., 2],
+    )
+    B = mean_input - np.einsum('...k,...k->...', A, mean_guide)
+
+    return box_mean(A, window_size), box_mean(B, window_size)
+
+
+def guided_filter_color(input, guide_image, window_size=30, eps=EPS_GF, box_filter=True):
+    compute_function = compute_guided_filter_color_box if box_filter else compute_guided_filter_color
+    mean_A, mean_B = compute_function(input, guide_image, window_size, eps)
     return combine_meanA_meanB_guide(mean_A, guide_image, mean_B, input)
 
 
-def fast_guided_filter_color(input, guide_image, scale_factor=4, window_size=40, eps=EPS_GF):
-    mean_A, mean_B = compute_fast_guided_filter(compute_guided_filter_color, input, guide_image, scale_factor, window_size, eps)
+def fast_guided_filter_color(input, guide_image, scale_factor=4, window_size=40, eps=EPS_GF, box_filter=True):
+    compute_function = compute_guided_filter_color_box if box_filter else compute_guided_filter_color
+    mean_A, mean_B = compute_fast_guided_filter(compute_function, input, guide_image, scale_factor, window_size, eps)
     return combine_meanA_meanB_guide(mean_A, guide_image, mean_B, input)
+
+
+def guided_filter_coefficients(input, guide_image, window_size=40, eps=EPS_GF, color_guide=False, fast=True, scale_factor=4, box_filter=True):
+    """mean_A and mean_B of the (fast) guided filter, the output being apply_guided_filter(mean_A, mean_B, guide_image)."""
+    if color_guide:
+        compute_function = compute_guided_filter_color_box if box_filter else compute_guided_filter_color
+    else:
+        compute_function = compute_guided_filter_grey_box if box_filter else compute_guided_filter_grey
+    if fast:
+        return compute_fast_guided_filter(compute_function, input, guide_image, scale_factor, window_size, eps)
+    return compute_function(input, guide_image, window_size, eps)
+
+
+def apply_guided_filter(mean_A, mean_B, guide_image):
+    if guide_image.ndim == 3:
+        return combine_meanA_meanB_guide(mean_A, guide_image, mean_B)
+    return mean_A * guide_image + mean_B
+
+
+def guided_upsample(input_small, guide_small, guide_image, window_size=PYRAMID_WINDOW_SIZE, eps=PYRAMID_EPS, color_guide=False):
+    """
+    Joint upsampling of input_small (e.g. a transmission estimated on a downsampled image) to the resolution of guide_image:
+    the guided filter coefficients of input_small with guide_small (the downsampled guide) are bilinearly upsampled
+    and applied to guide_image, so that the output follows the edges of the full resolution guide.
+    """
+    mean_A, mean_B = guided_filter_coefficients(input_small, guide_small, window_size, eps, color_guide=color_guide, fast=False)
+    h, w = guide_image.shape[:2]
+    mean_A = cv2.resize(mean_A, (w, h), interpolation=cv2.INTER_LINEAR)
+    mean_B = cv2.resize(mean_B, (w, h), interpolation=cv2.INTER_LINEAR)
+    return apply_guided_filter(mean_A, mean_B, guide_image)
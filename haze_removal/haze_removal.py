@@ -1,18 +1,49 @@
+import copy
+import logging
+import numba
+import cv2
 import numpy as np
-import skimage.exposure as exposure
 from warnings import warn
-from time import time
-from scipy.ndimage import minimum_filter
-from scipy.sparse import identity, diags
-from scipy.sparse.linalg import cg, aslinearoperator
+from scipy.sparse import identity
 
-from .constants import PATCH_SIZE, OMEGA, T0, LAMBDA, EPS_SM, EPS_GF, R, OPAQUE
-from .laplacian import compute_laplacian
-from .guided_filter import guided_filter_grey, guided_filter_color, fast_guided_filter_grey, fast_guided_filter_color
+from .constants import PATCH_SIZE, OMEGA, T0, LAMBDA, EPS_SM, EPS_GF, R, OPAQUE, SOLVER
+from .dark_channel import dark_channel
+from .laplacian import compute_laplacian, MattingLaplacianOperator, symmetric_from_upper, sparse_nbytes, legacy_laplacian_nbytes
+from .solvers import solve_linear_system, coarse_to_fine_initial_guess
+from .utils import to_float_image
+from .guided_filter import guided_filter_coefficients, apply_guided_filter, guided_upsample
+from .cache import sparse_to_arrays, arrays_to_sparse
+from .profiling import Profiler
+from .radiance import recover_radiance, clip_unit, gamma_lut
+
+
+logger = logging.getLogger(__name__)
+
+
+def default_window_size(shape):
+    return int(10 * 3/2 * (np.sqrt(max(shape[:2])) // 10))
+
+
+def quadtree_atmospheric_light(image, min_size=32):
+    """
+    Hierarchical search of the atmospheric light (Kim et al., 2013): the image is recursively split
+    into quadrants, keeping the one with the highest mean minus standard deviation of intensity,
+    and the pixel closest to white is picked in the final region.
+    """
+    intensity = np.mean(image, axis=2)
+    y0, y1, x0, x1 = 0, image.shape[0], 0, image.shape[1]
+    while min(y1 - y0, x1 - x0) > min_size:
+        ym, xm = (y0 + y1) // 2, (x0 + x1) // 2
+        quadrants = [(y0, ym, x0, xm), (y0, ym, xm, x1), (ym, y1, x0, xm), (ym, y1, xm, x1)]
+        scores = [np.mean(intensity[a:b, c:d]) - np.std(intensity[a:b, c:d]) for a, b, c, d in quadrants]
+        y0, y1, x0, x1 = quadrants[int(np.argmax(scores))]
+
+    region = image[y0:y1, x0:x1].reshape((-1, image.shape[2]))
+    return region[np.argmin(np.sum((1 - region) ** 2, axis=1))]
 
 
 class HazeRemover:
-    def __init__(self, image, patch_size=PATCH_SIZE, omega=OMEGA, t0=T0, lambd=LAMBDA, eps_sm=EPS_SM, eps_gf=EPS_GF, r=R, opaque=OPAQUE,  window_size=None, use_soft_matting=True, guided_image_filtering=False, fast_guide_filter=True, print_intermediate=True):
+    def __init__(self, image, patch_size=PATCH_SIZE, omega=OMEGA, t0=T0, lambd=LAMBDA, eps_sm=EPS_SM, eps_gf=EPS_GF, r=R, opaque=OPAQUE,  window_size=None, use_soft_matting=True, guided_image_filtering=False, fast_guide_filter=True, box_filter=True, color_guide=False, solver=SOLVER, warm_start=True, matrix_free_laplacian=False, laplacian_boundary=False, atmospheric_light=None, atmospheric_light_method="dark_channel", dtype=np.float64, cache=None, profiler=None, num_threads=None, gamma_lut_size=None, pyramid_size=None, print_intermediate=True):
         self.patch_size = patch_size
         self.omega = omega
         self.t0 = t0
@@ -23,103 +54,261 @@ class HazeRemover:
         self.r = r
         self.window_size = window_size
         self.print_intermediate = print_intermediate
-        self.image = image
+        self.image = to_float_image(image, dtype)
+        self.dtype = self.image.dtype
         self.use_soft_matting = use_soft_matting
         self.guided_image_filtering = guided_image_filtering
         self.fast_guide_filter = fast_guide_filter
+        self.box_filter = box_filter
+        self.color_guide = color_guide
+        self.solver = solver
+        self.warm_start = warm_start
+        self.matrix_free_laplacian = matrix_free_laplacian
+        # Whether the windows cropped by the image borders contribute to the laplacian (only windows fully inside otherwise)
+        self.laplacian_boundary = laplacian_boundary
+        self.soft_matting_stats = None
+        self.atmospheric_light = None if atmospheric_light is None else np.asarray(atmospheric_light, dtype=self.dtype)
+        self.atmospheric_light_method = atmospheric_light_method
+        self.dark_channel = None
+        # Optional ArrayCache, in which the laplacian, guided filter coefficients and refined transmission are stored
+        self.cache = cache
+        # Per-stage timings (and memory if profiler.track_memory) are collected in self.profiler.profile
+        self.profiler = Profiler() if profiler is None else profiler
+        # Number of threads of the parallel numba kernels, for the calling thread (all the cores by default)
+        if num_threads is not None:
+            numba.set_num_threads(num_threads)
+        # Entries of a lookup table for the gamma correction of remove_haze (e.g. 256 or 4096), exact powers if None
+        self.gamma_lut_size = gamma_lut_size
+        # Largest side of the coarse level the transmission is estimated on (see pyramid_transmission), full resolution if None
+        self.pyramid_size = pyramid_size
 
-    def extract_dark_channel(self, img):
-        return np.min(minimum_filter(img, self.patch_size), axis=2)
+    def extract_dark_channel(self, img, out=None):
+        return dark_channel(img, self.patch_size, out=out)
+
+    def compute_dark_channel(self):
+        # Dark channel of the input image, computed once and reused by the estimations that need it
+        if self.dark_channel is None:
+            with self.profiler.stage("dark_channel"):
+                self.dark_channel = self.extract_dark_channel(self.image)
+        return self.dark_channel
 
     def compute_atmospheric_light(self):
-        dark_channel = self.extract_dark_channel(self.image)
-        n = int(self.opaque * np.prod(dark_channel.shape))
-        brightest_dark_channel = np.argpartition(dark_channel.ravel(), -n)[-n:]
-
-        maximum_intensity = 0
-        self.atmospheric_light = None
-        interest_zone = self.image.reshape((np.prod(dark_channel.shape), -1))[brightest_dark_channel]
-        for pixel in interest_zone:
-            intensity = np.sum(pixel)
-            if intensity > maximum_intensity:
-                maximum_intensity = intensity
-                self.atmospheric_light = pixel
+        if self.atmospheric_light_method not in ("dark_channel", "quadtree"):
+            raise ValueError(f"Unknown atmospheric light method: {self.atmospheric_light_method}")
+
+        with self.profiler.stage("atmospheric_light", method=self.atmospheric_light_method):
+            if self.atmospheric_light_method == "quadtree":
+                self.atmospheric_light = quadtree_atmospheric_light(self.image)
+                return
+
+            dark_channel = self.compute_dark_channel()
+            n = max(1, int(self.opaque * dark_channel.size))
+            brightest_dark_channel = np.argpartition(dark_channel.ravel(), -n)[-n:]
+
+            interest_zone = self.image.reshape((dark_channel.size, -1))[brightest_dark_channel]
+            self.atmospheric_light = interest_zone[np.argmax(np.sum(interest_zone, axis=1))]
 
     def compute_transmission(self):
-        dark_channel_normalized = self.extract_dark_channel(self.image / self.atmospheric_light[None, None])
-        self.transmission = 1 - self.omega * dark_channel_normalized
+        with self.profiler.stage("transmission"):
+            dark_channel_normalized = self.extract_dark_channel(self.image / self.atmospheric_light[None, None])
+            self.transmission = 1 - self.omega * dark_channel_normalized
+
+    def compute_soft_matting_system(self, image, transmission):
+        if self.matrix_free_laplacian:
+            A = MattingLaplacianOperator(image, self.eps_sm, self.r, shift=self.lambd)
+        else:
+            laplacian = self.compute_laplacian(image)
+            A = laplacian + self.lambd * identity(laplacian.shape[0], dtype=laplacian.dtype)
+        # The conjugate gradient runs in float64 even in float32 mode, as it does not converge in float32
+        b = self.lambd * transmission.ravel().astype(np.float64)
+        return A, b
 
-    def soft_matting(self):
-        print("Computing matting laplacian...")
-        start = time()
-        laplacian = compute_laplacian(self.image, self.eps_sm, self.r)
+    def compute_laplacian(self, image):
+        if self.cache is None:
+            return compute_laplacian(image, self.eps_sm, self.r, boundary=self.laplacian_boundary)
+        # Only the upper triangle of the symmetric laplacian is stored
+        arrays = self.cache.get_or_compute(
+            "laplacian", lambda: sparse_to_arrays(compute_laplacian(image, self.eps_sm, self.r, upper=True, boundary=self.laplacian_boundary)),
+            inputs=(image,), eps_sm=self.eps_sm, r=self.r, boundary=self.laplacian_boundary, upper=True,
+        )
+        return symmetric_from_upper(arrays_to_sparse(arrays))
+
+    def soft_matting(self, x0=None):
+        shape = self.image.shape[:2]
+
+        if x0 is None and self.warm_start:
+            logger.info("Solving coarse soft matte...")
+            with self.profiler.stage("coarse_soft_matting") as stage:
+                x0, coarse_stats = coarse_to_fine_initial_guess(self.image, self.transmission, self.compute_soft_matting_system, self.solver)
+                stage.info.update(coarse_stats or {})
+            if self.print_intermediate and coarse_stats is not None:
+                logger.info("Took {:2f}s to compute coarse soft matte ({} iterations)".format(stage.wall_time, coarse_stats["iterations"]))
+
+        logger.info("Computing matting laplacian...")
+        with self.profiler.stage("laplacian", matrix_free=self.matrix_free_laplacian) as stage:
+            A, b = self.compute_soft_matting_system(self.image, self.transmission)
+            if not self.matrix_free_laplacian:
+                # Memory of the compact matrix, and memory saved compared to the padded layout of _laplacian_internals
+                stage.info["nbytes"] = sparse_nbytes(A)
+                stage.info["saved_bytes"] = legacy_laplacian_nbytes(self.image.shape, self.r, self.dtype) - stage.info["nbytes"]
         if self.print_intermediate:
-            print("Took {:2f}s to compute laplacian".format(time() - start))
-
-        print("Soft matting...")
-        start = time()
-        A = laplacian + self.lambd * identity(laplacian.shape[0])
-        b = self.lambd * self.transmission.ravel()
-        M = aslinearoperator(diags(1.0 / A.diagonal()))
-        tmp, s = cg(A, b, M=M, maxiter=1000, tol=1e-4)
-        if s == 0:
-            self.transmission = tmp.reshape(self.image.shape[:2])
+            logger.info("Took {:2f}s to compute laplacian".format(stage.wall_time))
+
+        logger.info("Soft matting...")
+        with self.profiler.stage("soft_matting") as stage:
+            tmp, self.soft_matting_stats = solve_linear_system(A, b, shape, solver=self.solver, x0=x0)
+            stage.info.update(self.soft_matting_stats)
+        if self.soft_matting_stats["converged"]:
+            self.transmission = tmp.reshape(shape).astype(self.dtype)
         else:
             warn("Failed to compute soft matte")
 
         if self.print_intermediate:
-            print("Took {:2f}s to compute soft matte".format(time() - start))
+            logger.info("Took {:2f}s to compute soft matte ({} iterations, residual {:.2e})".format(
+                self.soft_matting_stats["time"], self.soft_matting_stats["iterations"], self.soft_matting_stats["residual"]))
+
+        return self.soft_matting_stats
 
     def guided_filtering(self):
-        start = time()
-        window_size = int(10 * 3/2 * (np.sqrt(max(self.image.shape[:2])) // 10)) if self.window_size is None else self.window_size
+        window_size = default_window_size(self.image.shape) if self.window_size is None else self.window_size
+
+        # ========= USING COLORED OR GREY INPUT AS GUIDED IMAGE =================
+        guide_image = self.image if self.color_guide else self.image[:,:,0]
 
-        # ========= USING GREY INPUT AS GUIDED IMAGE =================
-        refinement_method = fast_guided_filter_grey if self.fast_guide_filter else guided_filter_grey
+        def compute_coefficients():
+            mean_A, mean_B = guided_filter_coefficients(
+                self.transmission, guide_image, window_size=window_size, eps=self.eps_gf,
+                color_guide=self.color_guide, fast=self.fast_guide_filter, box_filter=self.box_filter,
+            )
+            return {"mean_A": mean_A, "mean_B": mean_B}
 
-        # ========= USING COLORED INPUT AS GUIDED IMAGE =================
-        # refinement_method = fast_guided_filter_color if self.fast_guide_filter else guided_filter_color
+        with self.profiler.stage("guided_filtering", window_size=window_size, fast=self.fast_guide_filter, color_guide=self.color_guide) as stage:
+            if self.cache is None:
+                coefficients = compute_coefficients()
+            else:
+                coefficients = self.cache.get_or_compute(
+                    "guided_filter", compute_coefficients, inputs=(self.transmission, guide_image),
+                    window_size=window_size, eps_gf=self.eps_gf, color_guide=self.color_guide,
+                    fast_guide_filter=self.fast_guide_filter, box_filter=self.box_filter,
+                )
 
-        self.transmission = refinement_method(self.transmission, self.image[:,:,0], window_size=window_size, eps=self.eps_gf)
+            self.transmission = apply_guided_filter(coefficients["mean_A"], coefficients["mean_B"], guide_image)
         if self.print_intermediate:
             method_name = "fast guided filtering" if self.fast_guide_filter else "guided filtering"
-            print("Took {:2f}s to perform {}".format(time() - start, method_name))
+            method_name += " (color guide)" if self.color_guide else ""
+            logger.info("Took {:2f}s to perform {}".format(stage.wall_time, method_name))
 
-    def compute_radiance(self):
-        self.radiance = (self.image - self.atmospheric_light) / np.expand_dims(np.maximum(self.transmission, self.t0), -1) + self.atmospheric_light
-        if (self.radiance < 0).any() or (self.radiance > 1).any():
-            warn("Clipping radiance")
-            self.radiance = np.clip(self.radiance, 0, 1)
+    def compute_radiance(self, out=None, gamma=1):
+        with self.profiler.stage("radiance", gamma=gamma) as stage:
+            # Radiance, clipping and gamma correction in a single pass writing to out if given
+            # (e.g. a preallocated or memory-mapped output), without temporaries
+            lut = None if self.gamma_lut_size is None or gamma == 1 else gamma_lut(gamma, self.gamma_lut_size)
+            self.radiance, below, above = recover_radiance(self.image, self.transmission, self.atmospheric_light, self.t0, gamma, lut, out)
+            stage.info["clipped"] = below + above > 0
+            stage.info["clipped_below"], stage.info["clipped_above"] = below, above
+            if stage.info["clipped"]:
+                warn("Clipping radiance")
 
 
-    def increase_exposure(self, value=1):
-        self.radiance = exposure.adjust_gamma(self.radiance, gamma=value) # gain
+    def increase_exposure(self, value=1, out=None):
+        with self.profiler.stage("exposure"):
+            if value != 1:
+                self.radiance = np.power(self.radiance, value, out=out) # gain
 
-    def remove_haze(self, correct_exposition=1):
-        start = time()
+    def refine_transmission(self, initial_transmission=None):
+        method = "soft_matting" if self.use_soft_matting else "guided_filtering" if self.guided_image_filtering else "none"
+        with self.profiler.stage("refine_transmission", method=method):
+            # initial_transmission (e.g. the transmission of the previous video frame) warm-starts soft matting
+            if self.use_soft_matting and self.cache is not None and initial_transmission is None:
+                # The solution of the soft matting system only depends on the image and the raw transmission
+                def compute_soft_matte():
+                    self.soft_matting()
+                    return {"transmission": self.transmission}
 
-        print("Computing atmospheric light...")
-        self.compute_atmospheric_light()
+                arrays = self.cache.get_or_compute(
+                    "soft_matting", compute_soft_matte,
+                    inputs=(self.image, self.transmission),
+                    eps_sm=self.eps_sm, r=self.r, lambd=self.lambd, solver=self.solver, warm_start=self.warm_start,
+                    matrix_free_laplacian=self.matrix_free_laplacian, laplacian_boundary=self.laplacian_boundary,
+                )
+                self.transmission = np.array(arrays["transmission"])
+            elif self.use_soft_matting:
+                self.soft_matting(x0=None if initial_transmission is None else initial_transmission.ravel())
+            elif self.guided_image_filtering:
+                logger.info("Guided filtering...")
+                self.guided_filtering()
 
-        print("Computing transmission...")
-        self.compute_transmission()
+            # A refined transmission is a new array, clipped in place (the raw one may be kept by the caller)
+            refined = self.use_soft_matting or self.guided_image_filtering
+            transmission, clipped = clip_unit(self.transmission, out=self.transmission if refined else None)
+            if clipped:
+                warn("Clipping transmission")
+                self.transmission = transmission
 
-        if self.use_soft_matting:
-            self.soft_matting()
-        elif self.guided_image_filtering:
-            print("Guided filtering...")
-            self.guided_filtering()
+    @property
+    def uses_pyramid(self):
+        """Whether the transmission is estimated at a coarse level (see pyramid_transmission)."""
+        return self.pyramid_size is not None and max(self.image.shape[:2]) > self.pyramid_size
 
-        if (self.transmission < 0).any() or (self.transmission > 1).any():
-            warn("Clipping transmission")
-            self.transmission = np.clip(self.transmission, 0, 1)
+    def pyramid_transmission(self):
+        """
+        Atmospheric light and refined transmission estimated on the image downsampled to pyramid_size, the parameters
+        applying at that level, and transmission brought back to full resolution by guided upsampling.
+        The cost of the refinement (e.g. soft matting) is the one of the coarse level.
+        """
+        h, w = self.image.shape[:2]
+        scale = self.pyramid_size / max(h, w)
+        coarse = copy.copy(self)
+        coarse.image = cv2.resize(self.image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+        coarse.dark_channel = None
+        coarse.pyramid_size = None
 
-        print("Computing radiance...")
-        self.compute_radiance()
+        with self.profiler.stage("coarse_level", shape=coarse.image.shape):
+            if coarse.atmospheric_light is None:
+                logger.info("Computing atmospheric light...")
+                coarse.compute_atmospheric_light()
+            logger.info("Computing transmission...")
+            coarse.compute_transmission()
+            coarse.refine_transmission()
+        self.atmospheric_light = coarse.atmospheric_light
 
-        print("Increasing exposure...")
-        self.increase_exposure(correct_exposition)
+        logger.info("Upsampling transmission...")
+        with self.profiler.stage("upsampling", scale=1 / scale):
+            coarse_guide = coarse.image if self.color_guide else coarse.image[:,:,0]
+            guide_image = self.image if self.color_guide else self.image[:,:,0]
+            self.transmission = guided_upsample(coarse.transmission, coarse_guide, guide_image, color_guide=self.color_guide)
+            # The upsampled transmission can overshoot [0, 1] slightly along edges
+            clip_unit(self.transmission, out=self.transmission)
 
-        print("Took {:2f}s to perform haze removal".format(time() - start))
+    def remove_haze(self, correct_exposition=1, radiance_out=None, transmission_out=None):
+        """
+        Radiance, transmission and atmospheric light of the image. The radiance and transmission are written to
+        radiance_out and transmission_out when they are given, e.g. preallocated arrays reused from an image to the next.
+        """
+        with self.profiler.stage("remove_haze", shape=self.image.shape, dtype=np.dtype(self.dtype).name) as stage:
+            if self.uses_pyramid:
+                self.pyramid_transmission()
+            else:
+                if self.atmospheric_light is None:
+                    logger.info("Computing atmospheric light...")
+                    self.compute_atmospheric_light()
+
+                logger.info("Computing transmission...")
+                self.compute_transmission()
+
+                self.refine_transmission()
+
+            if transmission_out is not None:
+                np.copyto(transmission_out, self.transmission)
+                self.transmission = transmission_out
+
+            logger.info("Computing radiance...")
+            self.compute_radiance(out=radiance_out, gamma=correct_exposition)
+
+        logger.info("Took {:2f}s to perform haze removal".format(stage.wall_time))
 
         return self.radiance, self.transmission, self.atmospheric_light
+
+    @property
+    def profile(self):
+        return self.profiler.profile
@@ -0,0 +1,215 @@
+import logging
+import numpy as np
+from warnings import warn
+from scipy.sparse import identity
+
+from .constants import PREVIEW_SIZE
+from .dark_channel import dark_channel
+from .guided_filter import (
+    grey_guide_statistics, color_guide_statistics, compute_guided_filter_grey_box, compute_guided_filter_color_box,
+    apply_guided_filter,
+)
+from .haze_removal import HazeRemover, default_window_size
+from .io import resize_image
+from .laplacian import compute_laplacian
+from .profiling import Profiler
+from .radiance import recover_radiance, clip_unit
+from .solvers import build_preconditioner, solve_linear_system
+from .sweep import ParameterSweep, _default_parameters
+from .utils import to_float_image
+
+
+logger = logging.getLogger(__name__)
+
+
+class InteractiveSession:
+    """
+    Parameter tuning on one image, e.g. from a user interface. preview(roi, **parameters) dehazes a region of
+    interest of the image downsampled to preview_size. Only what the changed parameters invalidate is recomputed.
+    Intermediates stay resident, keyed on the parameters they depend on:
+    - on the whole preview: the dark channels, the atmospheric light and the box statistics of the guide;
+    - on the region: the matting laplacian and its preconditioner.
+    commit(**parameters) records the parameters to apply to the full image. The full-resolution result is only
+    computed when full_resolution() asks for it, with a ParameterSweep: successive commits only recompute the
+    stages downstream of the parameters that changed. It is the result of HazeRemover(image, **parameters).remove_haze(gamma)
+    for all the committed parameters (see benchmarks/evaluate_interactive.py).
+
+    Spatial parameters (patch_size, window_size) are in full resolution pixels, scaled down for the previews.
+    Previews refine the transmission with the (exact) guided filter using box filters, whatever fast_guide_filter,
+    at their own resolution whatever pyramid_size, and apply the exact gamma correction whatever gamma_lut_size.
+    """
+    def __init__(self, image, preview_size=PREVIEW_SIZE, profiler=None, **parameters):
+        self.image = image
+        self.parameters = {**_default_parameters(), **parameters, "print_intermediate": False}
+        # Downsampled before the conversion to floats, as in load_image
+        self.preview_image = to_float_image(resize_image(image, preview_size), self.parameters["dtype"])
+        self.scale = self.preview_image.shape[0] / image.shape[0]
+        self.profiler = Profiler() if profiler is None else profiler
+        # name -> (key, value) of the intermediates, and number of times each of them was computed
+        self.resident = {}
+        self.computations = {}
+        self.committed = None
+        self._sweep = None
+        self._full_resolution = None
+
+    def _resident(self, name, key, compute):
+        cached_key, value = self.resident.get(name, (None, None))
+        if cached_key != key:
+            with self.profiler.stage(name):
+                value = compute()
+            self.resident[name] = (key, value)
+            self.computations[name] = self.computations.get(name, 0) + 1
+        return value
+
+    def _preview_length(self, length):
+        return max(1, int(round(length * self.scale)))
+
+    def _preview_roi(self, roi):
+        # (y0, y1, x0, x1) in full resolution pixels to preview pixels, the whole preview if None
+        h, w = self.preview_image.shape[:2]
+        if roi is None:
+            return 0, h, 0, w
+        y0, y1, x0, x1 = roi
+        y0, x0 = max(0, int(np.floor(y0 * self.scale))), max(0, int(np.floor(x0 * self.scale)))
+        y1, x1 = min(h, int(np.ceil(y1 * self.scale))), min(w, int(np.ceil(x1 * self.scale)))
+        if y0 >= y1 or x0 >= x1:
+            raise ValueError(f"Empty region of interest: {roi}")
+        return y0, y1, x0, x1
+
+    def _atmospheric_light(self, parameters):
+        if parameters["atmospheric_light"] is not None:
+            return np.asarray(parameters["atmospheric_light"], dtype=self.preview_image.dtype)
+        patch_size = self._preview_length(parameters["patch_size"])
+        dark_channel_image = self._resident(
+            "dark_channel", (patch_size,), lambda: dark_channel(self.preview_image, patch_size),
+        )
+
+        def compute():
+            haze_remover = HazeRemover(
+                self.preview_image, patch_size=patch_size, opaque=parameters["opaque"],
+                atmospheric_light_method=parameters["atmospheric_light_method"], print_intermediate=False,
+            )
+            haze_remover.dark_channel = dark_channel_image
+            haze_remover.compute_atmospheric_light()
+            return haze_remover.atmospheric_light
+
+        return self._resident("atmospheric_light", (patch_size, parameters["opaque"], parameters["atmospheric_light_method"]), compute)
+
+    def _guided_filtering(self, transmission, region, parameters):
+        window_size = parameters["window_size"]
+        window_size = self._preview_length(default_window_size(self.image.shape) if window_size is None else window_size)
+        color_guide = parameters["color_guide"]
+        guide_image = self.preview_image if color_guide else self.preview_image[:, :, 0]
+
+        # Statistics of the whole preview guide, cropped to the region
+        statistics_function = color_guide_statistics if color_guide else grey_guide_statistics
+        mean_guide, var_guide = self._resident(
+            "guide_statistics", (window_size, color_guide), lambda: statistics_function(guide_image, window_size),
+        )
+        if color_guide:
+            var_guide = {pair: cov[region] for pair, cov in var_guide.items()}
+        else:
+            var_guide = var_guide[region]
+
+        compute_function = compute_guided_filter_color_box if color_guide else compute_guided_filter_grey_box
+        mean_A, mean_B = compute_function(
+            transmission, guide_image[region], window_size, parameters["eps_gf"], guide_statistics=(mean_guide[region], var_guide),
+        )
+        return apply_guided_filter(mean_A, mean_B, guide_image[region])
+
+    def _soft_matting(self, transmission, region, parameters):
+        image = np.ascontiguousarray(self.preview_image[region])
+        key = (region, parameters["eps_sm"], parameters["r"], parameters["laplacian_boundary"])
+        laplacian = self._resident(
+            "laplacian", key,
+            lambda: compute_laplacian(image, parameters["eps_sm"], parameters["r"], boundary=parameters["laplacian_boundary"]),
+        )
+        lambd, solver = parameters["lambd"], parameters["solver"]
+        A = self._resident("soft_matting_system", key + (lambd,), lambda: laplacian + lambd * identity(laplacian.shape[0], dtype=laplacian.dtype))
+        M = self._resident("preconditioner", key + (lambd, solver), lambda: build_preconditioner(A, transmission.shape, solver))
+
+        b = lambd * transmission.ravel().astype(np.float64)
+        with self.profiler.stage("soft_matting") as stage:
+            x, stats = solve_linear_system(A, b, transmission.shape, solver=solver, x0=transmission.ravel().astype(np.float64), M=M)
+            stage.info.update(stats)
+        if not stats["converged"]:
+            warn("Failed to compute soft matte")
+            return transmission
+        return x.reshape(transmission.shape).astype(transmission.dtype)
+
+    def preview(self, roi=None, **parameters):
+        """
+        Radiance, transmission and atmospheric light of the region of interest roi = (y0, y1, x0, x1) of the image
+        (in full resolution pixels, the whole image if None) at preview resolution. The parameters update the ones
+        of the session. The region is refined with a margin, so that guided filtering gives the same result as on
+        the whole preview (soft matting, a global problem, only approximately).
+        """
+        self.parameters.update(parameters)
+        parameters = self.parameters
+        y0, y1, x0, x1 = self._preview_roi(roi)
+
+        with self.profiler.stage("preview", roi=(y0, y1, x0, x1)) as stage:
+            atmospheric_light = self._atmospheric_light(parameters)
+            patch_size = self._preview_length(parameters["patch_size"])
+            normalized_dark_channel = self._resident(
+                "normalized_dark_channel", (patch_size, tuple(atmospheric_light)),
+                lambda: dark_channel(self.preview_image / atmospheric_light[None, None], patch_size),
+            )
+
+            # Region with its margin, and region within the margin
+            if parameters["use_soft_matting"]:
+                margin = 8 * parameters["r"]
+            elif parameters["guided_image_filtering"]:
+                window_size = parameters["window_size"]
+                window_size = self._preview_length(default_window_size(self.image.shape) if window_size is None else window_size)
+                margin = 2 * ((window_size - 1) // 2)
+            else:
+                margin = 0
+            h, w = self.preview_image.shape[:2]
+            my0, my1, mx0, mx1 = max(0, y0 - margin), min(h, y1 + margin), max(0, x0 - margin), min(w, x1 + margin)
+            region = (slice(my0, my1), slice(mx0, mx1))
+            inner = (slice(y0 - my0, y1 - my0), slice(x0 - mx0, x1 - mx0))
+
+            transmission = 1 - parameters["omega"] * normalized_dark_channel[region]
+            if parameters["use_soft_matting"]:
+                transmission = self._soft_matting(transmission, region, parameters)
+            elif parameters["guided_image_filtering"]:
+                transmission = self._guided_filtering(transmission, region, parameters)
+            transmission, clipped = clip_unit(np.ascontiguousarray(transmission[inner]))
+            if clipped:
+                warn("Clipping transmission")
+
+            image = self.preview_image[y0:y1, x0:x1]
+            radiance, below, above = recover_radiance(image, transmission, atmospheric_light, parameters["t0"], parameters["gamma"])
+            stage.info["clipped"] = below + above > 0
+            if stage.info["clipped"]:
+                warn("Clipping radiance")
+
+        return radiance, transmission, atmospheric_light
+
+    def commit(self, **parameters):
+        """
+        Records the parameters of the session, updated with the given ones, as the ones to apply to the full image.
+        Nothing is computed until full_resolution() is called.
+        """
+        self.parameters.update(parameters)
+        if self.committed != self.parameters:
+            self.committed = dict(self.parameters)
+            self._full_resolution = None
+
+    @property
+    def pending(self):
+        """Whether committed parameters have not been applied to the full image yet."""
+        return self.committed is not None and self._full_resolution is None
+
+    def full_resolution(self):
+        """Radiance, transmission and atmospheric light of the full image for the committed parameters."""
+        if self.committed is None:
+            raise ValueError("No parameters were committed")
+        if self._full_resolution is None:
+            logger.info("Applying the committed parameters to the full image...")
+            if self._sweep is None:
+                self._sweep = ParameterSweep(self.image, **self.committed)
+            with self.profiler.stage("full_resolution"):
+                self._full_resolution = self._sweep.run(**self.committed)
+        return self._full_resolution
@@ -0,0 +1,127 @@
+import os
+import numpy as np
+import cv2
+
+
+# Images are decoded and encoded with OpenCV, which is much faster than skimage and matplotlib,
+# and are kept in their integer type until HazeRemover converts them to floats
+
+def from_buffer(buffer, shape, dtype=np.uint8):
+    """Image viewing a caller-provided buffer (bytes, bytearray, memoryview, shared memory...) without copying it."""
+    return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+def open_raw(path, shape, dtype=np.uint8, mode='r'):
+    """Memory-mapped raw file of pixels, without header (mode='w+' creates it)."""
+    return np.memmap(path, dtype=dtype, mode=mode, shape=tuple(shape))
+
+
+def _swap_channels(image, dst=None):
+    # OpenCV decodes and encodes BGR(A) images: red and blue are swapped (in place if dst is image)
+    if image.ndim == 3 and image.shape[2] == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=dst)
+    if image.ndim == 3 and image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA, dst=dst)
+    return image
+
+
+def decode_image(data):
+    """RGB image (uint8, or uint16 for 16-bit files) decoded from the bytes of an encoded image (PNG, JPEG...)."""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_ANYDEPTH)
+    if image is None:
+        raise ValueError("Could not decode the image")
+    return _swap_channels(image, dst=image)
+
+
+def read_image(path):
+    """RGB image (uint8, or uint16 for 16-bit files) decoded from an image file."""
+    image = cv2.imread(path, cv2.IMREAD_COLOR | cv2.IMREAD_ANYDEPTH)
+    if image is None:
+        raise ValueError(f"Could not read the image {path}")
+    return _swap_channels(image, dst=image)
+
+
+def open_image_lazy(path, shape=None, dtype=np.uint8):
+    """
+    Opens an image without decoding it in memory when the format allows it:
+    .npy files, uncompressed .tif files and .raw files (of the given shape and dtype) are memory-mapped,
+    other formats are fully decoded.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy":
+        return np.load(path, mmap_mode='r')
+    if extension == ".raw":
+        if shape is None:
+            raise ValueError("The shape of a .raw image must be given")
+        return open_raw(path, shape, dtype)
+    if extension in (".tif", ".tiff"):
+        try:
+            import tifffile
+            return tifffile.memmap(path, mode='r')
+        except (ImportError, ValueError):
+            pass
+    return read_image(path)
+
+
+def open_output_array(path, shape, dtype=np.float32):
+    """Creates a memory-mapped .npy file that tiles can be written to incrementally."""
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+
+def resize_image(image, maxwh):
+    """
+    Image downscaled (with area interpolation) so that its largest side is at most maxwh.
+    Resizing before the conversion to floats processes 8 times less memory for uint8 images.
+    """
+    h, w = image.shape[:2]
+    if max(h, w) <= maxwh:
+        return image
+    size = (int(w*maxwh/h), maxwh) if h > w else (maxwh, int(h*maxwh/w))
+    return cv2.resize(np.asarray(image), size, interpolation=cv2.INTER_AREA)
+
+
+def to_uint8(image, out=None):
+    """
+    8-bit version of an image of floats in [0, 1] (rounded and saturated), written to out if given.
+    uint8 images are returned as they are.
+    """
+    if image.dtype == np.uint8:
+        return image
+    return cv2.convertScaleAbs(np.asarray(image), dst=out, alpha=255)
+
+
+def write_image(path, image, buffer=None):
+    """
+    Writes an RGB or grey image of floats in [0, 1] (or uint8). Encoded formats (.png, .jpg...) are written
+    in 8 bits with OpenCV, converting the image into buffer (a preallocated uint8 array of the same shape) if given.
+    .npy and .raw files store the values as they are, without encoding (see open_image_lazy).
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy":
+        np.save(path, image)
+        return
+    if extension == ".raw":
+        np.ascontiguousarray(image).tofile(path)
+        return
+
+    converted = to_uint8(image, buffer)
+    # The channels are swapped in place, unless converted is the caller's image
+    converted = _swap_channels(converted, dst=None if converted is image else converted)
+    if not cv2.imwrite(path, converted):
+        raise ValueError(f"Could not write the image {path}")
+
+
+def write_image_atomically(path, image):
+    """
+    write_image to a temporary file of the same folder, then renamed to path: path never holds a partially
+    written image, even if the process is interrupted.
+    """
+    root, extension = os.path.splitext(path)
+    # The extension is kept, as it selects the encoding
+    temporary_path = f"{root}.tmp{extension}"
+    try:
+        write_image(temporary_path, image)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
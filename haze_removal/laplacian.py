@@ -1,13 +1,19 @@
 import numpy as np
-from tqdm import tqdm
-from scipy.sparse import csr_matrix
-from numba import jit
+from scipy.sparse import csr_matrix, triu
+from scipy.sparse.linalg import LinearOperator
+from numba import njit, prange, float32, float64, int32, int64, boolean
 
+from .box_filter import box_sum
 
-@jit
+
+_SIGNATURES = [(t[:, :, :], float64, int64) for t in (float32, float64)]
+
+
+@njit(_SIGNATURES, cache=True)
 def _laplacian_internals(image, epsilon, r):
     """
     From https://github.com/pymatting/pymatting/
+    Serial reference: windows scatter their contributions into the rows of all their pixels.
     """
     image = image[..., :3]
     h, w, d = image.shape
@@ -17,7 +23,7 @@ def _laplacian_internals(image, epsilon, r):
 
     indptr = np.zeros(n + 1, dtype=np.int64)
     indices = np.zeros(n * (4 * r + 1) ** 2, dtype=np.int64)
-    values = np.zeros((n, 4 * r + 1, 4 * r + 1), dtype=np.float64)
+    values = np.zeros((n, 4 * r + 1, 4 * r + 1), dtype=image.dtype)
 
     for yi in range(h):
         for xi in range(w):
@@ -137,7 +143,408 @@ def _laplacian_internals(image, epsilon, r):
     return values, indices, indptr
 
 
-def compute_laplacian(image, epsilon, r):
+@njit(_SIGNATURES, parallel=True, cache=True)
+def _window_statistics(image, epsilon, r):
+    # Mean color and upper triangle of the inverse regularized color covariance of every window
+    # fully inside the image, indexed by the window center
+    h, w, _ = image.shape
+    size = 2 * r + 1
+    window_area = size * size
+    mean = np.zeros((h, w, 3))
+    inv_cov = np.zeros((h, w, 6))
+
+    for y in prange(r, h - r):
+        for x in range(r, w - r):
+            m = np.zeros(3)
+            for dy in range(size):
+                for dx in range(size):
+                    for dc in range(3):
+                        m[dc] += image[y + dy - r, x + dx - r, dc]
+            m /= window_area
+
+            a00 = epsilon
+            a01 = 0.0
+            a02 = 0.0
+            a11 = epsilon
+            a12 = 0.0
+            a22 = epsilon
+            for dy in range(size):
+                for dx in range(size):
+                    c0 = image[y + dy - r, x + dx - r, 0] - m[0]
+                    c1 = image[y + dy - r, x + dx - r, 1] - m[1]
+                    c2 = image[y + dy - r, x + dx - r, 2] - m[2]
+                    a00 += c0 * c0
+                    a01 += c0 * c1
+                    a02 += c0 * c2
+                    a11 += c1 * c1
+                    a12 += c1 * c2
+                    a22 += c2 * c2
+            a00 /= window_area
+            a01 /= window_area
+            a02 /= window_area
+            a11 /= window_area
+            a12 /= window_area
+            a22 /= window_area
+
+            m00 = a11 * a22 - a12 * a12
+            m01 = a02 * a12 - a01 * a22
+            m02 = a01 * a12 - a02 * a11
+            m11 = a00 * a22 - a02 * a02
+            m12 = a01 * a02 - a00 * a12
+            m22 = a00 * a11 - a01 * a01
+            inv_det = 1.0 / (a00 * m00 + a01 * m01 + a02 * m02)
+
+            mean[y, x] = m
+            inv_cov[y, x, 0] = m00 * inv_det
+            inv_cov[y, x, 1] = m01 * inv_det
+            inv_cov[y, x, 2] = m02 * inv_det
+            inv_cov[y, x, 3] = m11 * inv_det
+            inv_cov[y, x, 4] = m12 * inv_det
+            inv_cov[y, x, 5] = m22 * inv_det
+    return mean, inv_cov
+
+
+@njit(_SIGNATURES, parallel=True, cache=True)
+def _laplacian_internals_gather(image, epsilon, r):
+    """
+    Same matrix as _laplacian_internals, computed row by row in parallel: the row of each pixel i
+    gathers the contributions of the windows containing i, so that every thread writes its own rows only.
+    """
+    image = image[..., :3]
+    h, w, d = image.shape
+    n = h * w
+    size = 2 * r + 1
+    window_area = size * size
+    width = 4 * r + 1
+
+    mean, inv_cov = _window_statistics(image, epsilon, r)
+
+    indptr = np.arange(n + 1) * width * width
+    indices = np.zeros(n * width * width, dtype=np.int64)
+    values = np.zeros((n, width, width), dtype=image.dtype)
+
+    for yi in prange(h):
+        row = np.zeros((width, width))
+        for xi in range(w):
+            i = xi + yi * w
+            k = i * width * width
+            for yj in range(yi - 2 * r, yi + 2 * r + 1):
+                for xj in range(xi - 2 * r, xi + 2 * r + 1):
+                    if 0 <= xj < w and 0 <= yj < h:
+                        indices[k] = xj + yj * w
+                    k += 1
+
+            row[:, :] = 0.0
+            # Windows containing pixel i, fully inside the image
+            for y in range(max(r, yi - r), min(h - r, yi + r + 1)):
+                for x in range(max(r, xi - r), min(w - r, xi + r + 1)):
+                    s = image[yi, xi, 0] - mean[y, x, 0]
+                    t = image[yi, xi, 1] - mean[y, x, 1]
+                    u = image[yi, xi, 2] - mean[y, x, 2]
+                    c0 = inv_cov[y, x, 0] * s + inv_cov[y, x, 1] * t + inv_cov[y, x, 2] * u
+                    c1 = inv_cov[y, x, 1] * s + inv_cov[y, x, 3] * t + inv_cov[y, x, 4] * u
+                    c2 = inv_cov[y, x, 2] * s + inv_cov[y, x, 4] * t + inv_cov[y, x, 5] * u
+
+                    # Pixels j of the window
+                    for yj in range(y - r, y + r + 1):
+                        for xj in range(x - r, x + r + 1):
+                            temp = (
+                                c0 * (image[yj, xj, 0] - mean[y, x, 0])
+                                + c1 * (image[yj, xj, 1] - mean[y, x, 1])
+                                + c2 * (image[yj, xj, 2] - mean[y, x, 2])
+                            )
+                            row[yj - yi + 2 * r, xj - xi + 2 * r] -= (1 + temp) / window_area
+                    row[2 * r, 2 * r] += 1.0
+
+            for dy in range(width):
+                for dx in range(width):
+                    values[i, dy, dx] = row[dy, dx]
+    return values, indices, indptr
+
+
+# ========= COMPACT LAPLACIAN =================
+# Only the entries (i, j) of pixels sharing at least one window are stored (the others are structural zeros,
+# kept explicitly by the kernels above, as are the slots of out-of-image neighbours), optionally only the upper
+# triangle (j >= i) as the laplacian is symmetric, with int32 indices when the number of entries allows it.
+# Windows cropped by the image borders can also be included (boundary=True), with their actual number of pixels.
+
+def _axis_sharing(length, r, boundary):
+    """
+    (length, 4r + 1) table telling whether the positions a and a + d - 2r along an axis of the given length
+    are both in the image and share the center of a window (windows fully inside the image unless boundary is set).
+    """
+    position = np.arange(length)
+    lo = np.maximum(0 if boundary else r, position - r)
+    hi = np.minimum(length - 1 if boundary else length - 1 - r, position + r)
+    other = position[:, None] + np.arange(-2 * r, 2 * r + 1)
+    inside = (0 <= other) & (other < length)
+    other = np.clip(other, 0, length - 1)
+    return inside & (np.maximum(lo[:, None], lo[other]) <= np.minimum(hi[:, None], hi[other]))
+
+
+def _compact_row_counts(shares_y, shares_x, upper):
+    # Number of stored entries of each row: pairs sharing a window along both axes, with j >= i if upper
+    r2 = (shares_y.shape[1] - 1) // 2
+    if not upper:
+        return np.outer(shares_y.sum(axis=1), shares_x.sum(axis=1)).ravel()
+    # Rows below, and the same row on the right (including the diagonal)
+    below = np.outer(shares_y[:, r2 + 1:].sum(axis=1), shares_x.sum(axis=1))
+    right = np.outer(shares_y[:, r2], shares_x[:, r2:].sum(axis=1))
+    return (below + right).ravel()
+
+
+@njit([(t[:, :, :], float64, int64, boolean) for t in (float32, float64)], parallel=True, cache=True)
+def _cropped_window_statistics(image, epsilon, r, boundary):
+    # Same as _window_statistics, with the number of pixels of each window, cropped by the image borders
+    # when boundary is set (windows of centers closer than r to the borders are skipped otherwise)
+    h, w, _ = image.shape
+    mean = np.zeros((h, w, 3))
+    inv_cov = np.zeros((h, w, 6))
+    area = np.zeros((h, w))
+    lo = 0 if boundary else r
+
+    for y in prange(lo, h - lo):
+        for x in range(lo, w - lo):
+            y0, y1, x0, x1 = max(0, y - r), min(h, y + r + 1), max(0, x - r), min(w, x + r + 1)
+            window_area = (y1 - y0) * (x1 - x0)
+            m = np.zeros(3)
+            for yj in range(y0, y1):
+                for xj in range(x0, x1):
+                    for dc in range(3):
+                        m[dc] += image[yj, xj, dc]
+            m /= window_area
+
+            a00 = epsilon
+            a01 = 0.0
+            a02 = 0.0
+            a11 = epsilon
+            a12 = 0.0
+            a22 = epsilon
+            for yj in range(y0, y1):
+                for xj in range(x0, x1):
+                    c0 = image[yj, xj, 0] - m[0]
+                    c1 = image[yj, xj, 1] - m[1]
+                    c2 = image[yj, xj, 2] - m[2]
+                    a00 += c0 * c0
+                    a01 += c0 * c1
+                    a02 += c0 * c2
+                    a11 += c1 * c1
+                    a12 += c1 * c2
+                    a22 += c2 * c2
+            a00 /= window_area
+            a01 /= window_area
+            a02 /= window_area
+            a11 /= window_area
+            a12 /= window_area
+            a22 /= window_area
+
+            m00 = a11 * a22 - a12 * a12
+            m01 = a02 * a12 - a01 * a22
+            m02 = a01 * a12 - a02 * a11
+            m11 = a00 * a22 - a02 * a02
+            m12 = a01 * a02 - a00 * a12
+            m22 = a00 * a11 - a01 * a01
+            inv_det = 1.0 / (a00 * m00 + a01 * m01 + a02 * m02)
+
+            mean[y, x] = m
+            area[y, x] = window_area
+            inv_cov[y, x, 0] = m00 * inv_det
+            inv_cov[y, x, 1] = m01 * inv_det
+            inv_cov[y, x, 2] = m02 * inv_det
+            inv_cov[y, x, 3] = m11 * inv_det
+            inv_cov[y, x, 4] = m12 * inv_det
+            inv_cov[y, x, 5] = m22 * inv_det
+    return mean, inv_cov, area
+
+
+@njit([(t[:, :, :], float64, int64, boolean, boolean, boolean[:, :], boolean[:, :], i[:], i[:], t[:]) for t in (float32, float64) for i in (int32, int64)], parallel=True, cache=True)
+def _laplacian_internals_compact(image, epsilon, r, upper, boundary, shares_y, shares_x, indptr, indices, data):
+    """
+    Rows of the compact laplacian written to indices and data, allocated from indptr
+    (see _axis_sharing and _compact_row_counts).
+    As in _laplacian_internals_gather, the row of each pixel i gathers the contributions of the windows containing i.
+    """
+    image = image[..., :3]
+    h, w, d = image.shape
+    width = 4 * r + 1
+
+    mean, inv_cov, area = _cropped_window_statistics(image, epsilon, r, boundary)
+    lo = 0 if boundary else r
+
+    for yi in prange(h):
+        row = np.zeros((width, width))
+        for xi in range(w):
+            i = xi + yi * w
+
+            row[:, :] = 0.0
+            for y in range(max(lo, yi - r), min(h - lo, yi + r + 1)):
+                for x in range(max(lo, xi - r), min(w - lo, xi + r + 1)):
+                    s = image[yi, xi, 0] - mean[y, x, 0]
+                    t = image[yi, xi, 1] - mean[y, x, 1]
+                    u = image[yi, xi, 2] - mean[y, x, 2]
+                    c0 = inv_cov[y, x, 0] * s + inv_cov[y, x, 1] * t + inv_cov[y, x, 2] * u
+                    c1 = inv_cov[y, x, 1] * s + inv_cov[y, x, 3] * t + inv_cov[y, x, 4] * u
+                    c2 = inv_cov[y, x, 2] * s + inv_cov[y, x, 4] * t + inv_cov[y, x, 5] * u
+
+                    for yj in range(max(0, y - r), min(h, y + r + 1)):
+                        for xj in range(max(0, x - r), min(w, x + r + 1)):
+                            temp = (
+                                c0 * (image[yj, xj, 0] - mean[y, x, 0])
+                                + c1 * (image[yj, xj, 1] - mean[y, x, 1])
+                                + c2 * (image[yj, xj, 2] - mean[y, x, 2])
+                            )
+                            row[yj - yi + 2 * r, xj - xi + 2 * r] -= (1 + temp) / area[y, x]
+                    row[2 * r, 2 * r] += 1.0
+
+            # Entries in increasing column order, as in a canonical CSR matrix
+            k = indptr[i]
+            for dy in range(2 * r if upper else 0, width):
+                if not shares_y[yi, dy]:
+                    continue
+                for dx in range(2 * r if upper and dy == 2 * r else 0, width):
+                    if shares_x[xi, dx]:
+                        indices[k] = xi + dx - 2 * r + (yi + dy - 2 * r) * w
+                        data[k] = row[dy, dx]
+                        k += 1
+
+
+def compute_compact_laplacian(image, epsilon, r, upper=False, boundary=False):
+    """
+    Matting laplacian of image as a CSR matrix without explicit zeros, with int32 indices when possible:
+    the same matrix as compute_laplacian (within rounding) for boundary=False, in less memory (see sparse_nbytes).
+    upper only stores the upper triangle (symmetric_from_upper gives back the full matrix), boundary adds the
+    contributions of the windows cropped by the image borders.
+    """
+    h, w = image.shape[:2]
+    n = h * w
+    shares_y, shares_x = _axis_sharing(h, r, boundary), _axis_sharing(w, r, boundary)
+    counts = _compact_row_counts(shares_y, shares_x, upper)
+    nnz = int(counts.sum())
+    index_dtype = np.int32 if max(nnz, n) <= np.iinfo(np.int32).max else np.int64
+
+    indptr = np.zeros(n + 1, dtype=index_dtype)
+    np.cumsum(counts, out=indptr[1:])
+    indices = np.empty(nnz, dtype=index_dtype)
+    data = np.empty(nnz, dtype=image.dtype)
+    _laplacian_internals_compact(
+        np.ascontiguousarray(image[..., :3]), epsilon, r, upper, boundary, shares_y, shares_x, indptr, indices, data,
+    )
+    return csr_matrix((data, indices, indptr), (n, n))
+
+
+def symmetric_from_upper(upper):
+    """Full symmetric matrix from its upper triangle (including the diagonal)."""
+    return (upper + triu(upper, k=1, format='csr').T).tocsr()
+
+
+def sparse_nbytes(matrix):
+    """Memory used by the arrays of a CSR matrix, in bytes."""
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+def legacy_laplacian_nbytes(shape, r, dtype=np.float64):
+    """Memory allocated by _laplacian_internals for an image of the given shape: dense values cube and int64 indices."""
+    n = shape[0] * shape[1]
+    slots = n * (4 * r + 1) ** 2
+    return slots * (np.dtype(dtype).itemsize + 8) + (n + 1) * 8
+
+
+def compute_laplacian(image, epsilon, r, parallel=True, compact=True, upper=False, boundary=False):
+    """
+    Matting laplacian of image as a CSR matrix. The parallel kernels run on numba's threads
+    (see numba.set_num_threads), the serial one is the reference implementation.
+    The compact kernel (see compute_compact_laplacian) is used unless compact=False or parallel=False.
+    """
+    if compact and parallel:
+        return compute_compact_laplacian(image, epsilon, r, upper=upper, boundary=boundary)
     n = np.prod(image.shape[:2])
-    values, indices, indptr = _laplacian_internals(image, epsilon, r)
+    laplacian_internals = _laplacian_internals_gather if parallel else _laplacian_internals
+    values, indices, indptr = laplacian_internals(image, epsilon, r)
     return csr_matrix((values.ravel(), indices, indptr), (n, n))
+
+
+class MattingLaplacianOperator(LinearOperator):
+    """
+    Matrix-free matting laplacian (plus shift * identity), equal to compute_laplacian(image, epsilon, r)
+    but applied from the per-window means and inverse covariances with box filters,
+    so that only a few arrays of the size of the image are stored.
+    """
+    def __init__(self, image, epsilon, r, shift=0.0):
+        image = image[..., :3]
+        h, w = image.shape[:2]
+        n = h * w
+        super().__init__(np.float64, (n, n))
+
+        self.image = image
+        self.r = r
+        self.shift = shift
+        self.window_area = (2 * r + 1) ** 2
+
+        # Only windows fully inside the image contribute, as in _laplacian_internals
+        self.centers = np.zeros((h, w))
+        self.centers[r:h - r, r:w - r] = 1
+        self.windows_per_pixel = box_sum(self.centers, r)
+
+        # The window statistics and products are computed in float64 whatever the image dtype:
+        # the inverse covariances of flat windows are large and would amplify float32 rounding errors
+        image = image.astype(np.float64)
+        self.mean = box_sum(image, r) / self.window_area
+        cov = {}
+        for i in range(3):
+            for j in range(i, 3):
+                cov[i, j] = box_sum(image[:, :, i] * image[:, :, j], r) / self.window_area - self.mean[:, :, i] * self.mean[:, :, j]
+        for i in range(3):
+            cov[i, i] += epsilon / self.window_area
+
+        # Upper triangle of the inverse covariance of each window
+        self.inv_cov = np.empty((h, w, 6))
+        self.inv_cov[:, :, 0] = cov[1, 1] * cov[2, 2] - cov[1, 2] * cov[1, 2]
+        self.inv_cov[:, :, 1] = cov[0, 2] * cov[1, 2] - cov[0, 1] * cov[2, 2]
+        self.inv_cov[:, :, 2] = cov[0, 1] * cov[1, 2] - cov[0, 2] * cov[1, 1]
+        self.inv_cov[:, :, 3] = cov[0, 0] * cov[2, 2] - cov[0, 2] * cov[0, 2]
+        self.inv_cov[:, :, 4] = cov[0, 1] * cov[0, 2] - cov[0, 0] * cov[1, 2]
+        self.inv_cov[:, :, 5] = cov[0, 0] * cov[1, 1] - cov[0, 1] * cov[0, 1]
+        det = cov[0, 0] * self.inv_cov[:, :, 0] + cov[0, 1] * self.inv_cov[:, :, 1] + cov[0, 2] * self.inv_cov[:, :, 2]
+        self.inv_cov *= (self.centers / np.where(self.centers > 0, det, 1))[:, :, None]
+
+    def _inv_cov_dot(self, v, m=None):
+        m = self.inv_cov if m is None else m
+        out = np.empty_like(v)
+        out[:, :, 0] = m[:, :, 0] * v[:, :, 0] + m[:, :, 1] * v[:, :, 1] + m[:, :, 2] * v[:, :, 2]
+        out[:, :, 1] = m[:, :, 1] * v[:, :, 0] + m[:, :, 3] * v[:, :, 1] + m[:, :, 4] * v[:, :, 2]
+        out[:, :, 2] = m[:, :, 2] * v[:, :, 0] + m[:, :, 4] * v[:, :, 1] + m[:, :, 5] * v[:, :, 2]
+        return out
+
+    def _matvec(self, x):
+        h, w = self.image.shape[:2]
+        x = x.reshape((h, w)).astype(np.float64)
+
+        mean_x = box_sum(x, self.r) / self.window_area
+        mean_image_x = box_sum(self.image * x[:, :, None], self.r) / self.window_area
+
+        a = self._inv_cov_dot(mean_image_x - self.mean * mean_x[:, :, None])
+        b = (mean_x - np.einsum('ijk,ijk->ij', a, self.mean)) * self.centers
+
+        out = (self.windows_per_pixel + self.shift) * x - box_sum(b, self.r) - np.einsum('ijk,ijk->ij', self.image, box_sum(a, self.r))
+        return out.ravel()
+
+    def _rmatvec(self, x):
+        return self._matvec(x)
+
+    def diagonal(self):
+        # Sum over the windows k containing each pixel i of (I_i - mean_k)^T inv_cov_k (I_i - mean_k),
+        # computed window offset by window offset as the expanded form cancels badly
+        h, w = self.image.shape[:2]
+        r = self.r
+        image = self.image.astype(np.float64)
+        mean = np.pad(self.mean, ((r, r), (r, r), (0, 0)))
+        inv_cov = np.pad(self.inv_cov, ((r, r), (r, r), (0, 0)))
+
+        distance = np.zeros((h, w))
+        for dy in range(2 * r + 1):
+            for dx in range(2 * r + 1):
+                centered = image - mean[dy:dy + h, dx:dx + w]
+                distance += np.einsum('ijk,ijk->ij', centered, self._inv_cov_dot(centered, inv_cov[dy:dy + h, dx:dx + w]))
+
+        diagonal = self.windows_per_pixel * (1 - 1 / self.window_area) - distance / self.window_area + self.shift
+        return diagonal.ravel()
@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import platform
+import resource
+import subprocess
+import numpy as np
+import numba
+import scipy
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+
+from .benchmarks import MATTING_METHODS
+from .haze_removal import HazeRemover
+from .profiling import Profiler
+from .utils import load_image
+
+
+PERFORMANCE_METHODS = {
+    **MATTING_METHODS,
+    "fast_color_guided": dict(use_soft_matting=False, guided_image_filtering=True, fast_guide_filter=True, color_guide=True),
+}
+
+
+def synthetic_image(size, seed=0):
+    """Reproducible hazy-looking 4:3 image whose largest side is size: smooth gradients, a haze veil and noise."""
+    h, w = size * 3 // 4, size
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:1:h * 1j, 0:1:w * 1j]
+    scene = np.stack([0.5 + 0.4 * np.sin(2 * np.pi * (f * x + g * y)) for f, g in rng.uniform(0.5, 4, (3, 2))], axis=-1)
+    depth = 0.2 + 0.8 * y[:, :, None]
+    transmission = np.exp(-1.5 * depth)
+    image = scene * transmission + 0.9 * (1 - transmission) + 0.02 * rng.standard_normal((h, w, 3))
+    return np.clip(image, 0, 1)
+
+
+def peak_rss():
+    """Peak resident set size of the current process, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _run_case(image, haze_remover_kwargs, repeats):
+    # Run in a new process, so that the first run includes the compilation of the numba kernels
+    # (the benchmarking process itself never runs the pipeline) and the peak RSS is the one of this case only
+    times, profile = [], None
+    for _ in range(1 + repeats):
+        profiler = Profiler()
+        start = perf_counter()
+        HazeRemover(image, **haze_remover_kwargs, profiler=profiler, print_intermediate=False).remove_haze()
+        times.append(perf_counter() - start)
+        profile = profiler.profile
+    return times, profile.wall_times(), peak_rss()
+
+
+def measure(image, method, repeats=3, name="image"):
+    """
+    Cold (first run in a new process) and warm (median of the following repeats) times of the haze removal
+    of image with a method of PERFORMANCE_METHODS, with its throughput, peak RSS and per-stage warm times.
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        times, stages, rss = executor.submit(_run_case, image, PERFORMANCE_METHODS[method], repeats).result()
+
+    h, w = image.shape[:2]
+    warm_time = float(np.median(times[1:])) if repeats > 0 else times[0]
+    return {
+        "image": name,
+        "method": method,
+        "height": h,
+        "width": w,
+        "megapixels": h * w / 1e6,
+        "cold_time": times[0],
+        "warm_times": times[1:],
+        "warm_time": warm_time,
+        "megapixels_per_second": h * w / 1e6 / warm_time,
+        "peak_rss_mb": rss / 2 ** 20,
+        "stages": stages,
+    }
+
+
+def scaling_exponents(results):
+    """
+    Exponent k of warm_time ~ pixels ** k for each (image, method), fitted in log-log over the resolutions:
+    1 means linear scaling.
+    """
+    curves = {}
+    for result in results:
+        curves.setdefault((result["image"], result["method"]), []).append((result["megapixels"], result["warm_time"]))
+    exponents = {}
+    for (image, method), points in curves.items():
+        if len(points) > 1:
+            megapixels, times = np.log(np.array(points)).T
+            exponents[f"{image}/{method}"] = float(np.polyfit(megapixels, times, 1)[0])
+    return exponents
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, cwd=os.path.dirname(__file__)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "numba": numba.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_performance_benchmark(images, sizes, methods=tuple(PERFORMANCE_METHODS), repeats=3, log=print):
+    """
+    Measures every method at every size on images, a dict of name -> path to an image file,
+    or None for a synthetic image. Returns a JSON-serializable report.
+    """
+    results = []
+    for name, path in images.items():
+        for size in sizes:
+            image = synthetic_image(size) if path is None else load_image(path, size, show_image=False)
+            for method in methods:
+                result = measure(image, method, repeats, name)
+                results.append(result)
+                log("{} {}x{} {}: cold {:.2f}s, warm {:.3f}s, {:.2f} MP/s, peak RSS {:.0f} MB".format(
+                    name, result["width"], result["height"], method, result["cold_time"], result["warm_time"],
+                    result["megapixels_per_second"], result["peak_rss_mb"]))
+    return {"environment": environment(), "results": results, "scaling_exponents": scaling_exponents(results)}
+
+
+def compare_reports(report, baseline, max_slowdown=0.1):
+    """Cases of report whose warm time is more than max_slowdown (relative) above the one of baseline."""
+    baseline_times = {(r["image"], r["method"], r["width"], r["height"]): r["warm_time"] for r in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        reference = baseline_times.get((result["image"], result["method"], result["width"], result["height"]))
+        if reference is not None and result["warm_time"] > (1 + max_slowdown) * reference:
+            regressions.append({**result, "baseline_warm_time": reference, "slowdown": result["warm_time"] / reference - 1})
+    return regressions
+
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
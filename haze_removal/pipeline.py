@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import os
+from time import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .batch import get_output_paths, warm_up
+from .constants import GAMMA
+from .haze_removal import HazeRemover
+from .io import open_image_lazy, resize_image, write_image, write_image_atomically
+
+
+logger = logging.getLogger(__name__)
+
+
+# Images flow through three stages connected by bounded queues: decoding (and resizing) and encoding run on
+# threads, as OpenCV releases the GIL, and dehazing on a single thread, or on worker processes. A full queue
+# blocks the stage feeding it, so that the pipeline runs at the speed of its slowest stage with at most
+# queue_size images waiting between two stages.
+
+_DONE = object()
+
+
+def _load(path, resize):
+    start = time()
+    # The image is resized in its integer type, and only converted to floats by HazeRemover
+    image = resize_image(open_image_lazy(path), resize)
+    return image, time() - start
+
+
+def _dehaze(image, gamma, haze_remover_kwargs):
+    haze_remover = HazeRemover(image, **{**haze_remover_kwargs, "print_intermediate": False})
+    radiance, transmission, _ = haze_remover.remove_haze(gamma)
+    return radiance, transmission, haze_remover.profile.wall_times()
+
+
+def _save(image, radiance, transmission, output_paths):
+    start = time()
+    write_image(output_paths["original"], image)
+    # The radiance is written last: its presence marks the image as processed, so it only appears once complete
+    write_image(output_paths["transmission"], transmission)
+    write_image_atomically(output_paths["radiance"], radiance)
+    return time() - start
+
+
+async def _run_stage(process, inbox, outbox, workers):
+    # workers tasks take items from inbox until the _DONE marker, which is forwarded to outbox once they all stop
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                await inbox.put(_DONE)
+                return
+            result = await process(item)
+            if result is not None:
+                await outbox.put(result)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    await outbox.put(_DONE)
+
+
+async def run_pipeline(paths, save_folder, resize=1400, gamma=GAMMA, overwrite=False, decoders=2, compute_workers=1, encoders=2, queue_size=2, **haze_remover_kwargs):
+    """
+    Dehazes a list of images, overlapping the decoding, the haze removal and the encoding of different images.
+    decoders and encoders are the numbers of images read and written concurrently. compute_workers is the number
+    of images dehazed concurrently: 1 runs the pipelines one after the other on a thread of this process (the numba
+    kernels running on all the cores), more runs them on worker processes. Images whose outputs already exist
+    are skipped unless overwrite is set. Returns the status and timing of every image, as process_images.
+    """
+    loop = asyncio.get_running_loop()
+    results = []
+    start = time()
+
+    def finish(result):
+        results.append(result)
+        logger.info("[{}/{}] {} {} ({:2f}s)".format(len(results), len(paths), result["path"], result["status"], result["time"]))
+
+    async def decode(path):
+        output_paths = get_output_paths(path, save_folder, resize, haze_remover_kwargs)
+        if not overwrite and all(os.path.exists(p) for p in output_paths.values()):
+            finish({"path": path, "status": "skipped", "time": 0.})
+            return None
+        try:
+            image, decode_time = await loop.run_in_executor(io_executor, _load, path, resize)
+        except Exception as error:
+            finish({"path": path, "status": f"failed: {error}", "time": 0.})
+            return None
+        return {"path": path, "output_paths": output_paths, "image": image, "time": decode_time, "stages": {"decode": decode_time}}
+
+    async def compute(item):
+        compute_start = time()
+        try:
+            item["radiance"], item["transmission"], stages = await loop.run_in_executor(
+                compute_executor, _dehaze, item["image"], gamma, haze_remover_kwargs,
+            )
+        except Exception as error:
+            finish({"path": item["path"], "status": f"failed: {error}", "time": item["time"]})
+            return None
+        item["stages"].update(stages)
+        item["time"] += time() - compute_start
+        return item
+
+    async def encode(item):
+        try:
+            encode_time = await loop.run_in_executor(
+                io_executor, _save, item["image"], item["radiance"], item["transmission"], item["output_paths"],
+            )
+        except Exception as error:
+            finish({"path": item["path"], "status": f"failed: {error}", "time": item["time"]})
+            return None
+        item["stages"]["encode"] = encode_time
+        finish({"path": item["path"], "status": "done", "time": item["time"] + encode_time, "stages": item["stages"]})
+        return None
+
+    if compute_workers > 1:
+        compute_executor = ProcessPoolExecutor(max_workers=compute_workers, initializer=warm_up, initargs=(haze_remover_kwargs,))
+    else:
+        # A single thread: the workqueue threading layer does not support concurrent kernel launches
+        compute_executor = ThreadPoolExecutor(max_workers=1)
+
+    path_queue = asyncio.Queue()
+    decoded = asyncio.Queue(maxsize=queue_size)
+    computed = asyncio.Queue(maxsize=queue_size)
+    for path in paths:
+        path_queue.put_nowait(path)
+    path_queue.put_nowait(_DONE)
+
+    with ThreadPoolExecutor(max_workers=decoders + encoders) as io_executor, compute_executor:
+        await asyncio.gather(
+            _run_stage(decode, path_queue, decoded, decoders),
+            _run_stage(compute, decoded, computed, compute_workers),
+            _run_stage(encode, computed, asyncio.Queue(), encoders),
+        )
+
+    logger.info("Took {:2f}s to process {} images".format(time() - start, len(paths)))
+    return results
+
+
+def pipeline_images(paths, save_folder, **kwargs):
+    """run_pipeline from synchronous code (see run_pipeline for the arguments)."""
+    return asyncio.run(run_pipeline(paths, save_folder, **kwargs))
@@ -0,0 +1,132 @@
+import tracemalloc
+from time import perf_counter, process_time
+from contextlib import contextmanager
+
+
+class StageProfile:
+    """
+    Measurements of one stage of the pipeline: wall and CPU times in seconds and, when memory is tracked,
+    the peak memory allocated during the stage and the memory still allocated at its end, in bytes.
+    info holds stage specific values, e.g. the iterations and residual of the soft matting solver.
+    """
+    def __init__(self, name, parent=None, **info):
+        self.name = name
+        self.parent = parent
+        self.wall_time = 0.
+        self.cpu_time = 0.
+        self.peak_memory = None
+        self.allocated_memory = None
+        self.info = info
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "parent": self.parent,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "peak_memory": self.peak_memory,
+            "allocated_memory": self.allocated_memory,
+            **self.info,
+        }
+
+    def __repr__(self):
+        return f"StageProfile({self.as_dict()})"
+
+
+class Profile:
+    """Profiles of the stages run so far, in the order they finished (nested stages before their parent)."""
+    def __init__(self):
+        self.stages = []
+
+    def __iter__(self):
+        return iter(self.stages)
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __getitem__(self, name):
+        # Last profile of the stage with this name
+        for stage in reversed(self.stages):
+            if stage.name == name:
+                return stage
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        return any(stage.name == name for stage in self.stages)
+
+    def wall_times(self):
+        """Total wall time of each stage name, summed over its runs."""
+        times = {}
+        for stage in self.stages:
+            times[stage.name] = times.get(stage.name, 0.) + stage.wall_time
+        return times
+
+    def as_dicts(self):
+        return [stage.as_dict() for stage in self.stages]
+
+    def summary(self):
+        lines = ["{:<24}{:>10}{:>10}{:>12}".format("stage", "wall (s)", "cpu (s)", "peak (MB)")]
+        for stage in self.stages:
+            peak = "" if stage.peak_memory is None else "{:.1f}".format(stage.peak_memory / 2 ** 20)
+            lines.append("{:<24}{:>10.3f}{:>10.3f}{:>12}".format(stage.name, stage.wall_time, stage.cpu_time, peak))
+        return "\n".join(lines)
+
+
+class Profiler:
+    """
+    Collects a StageProfile for each stage run within profiler.stage(name), into profiler.profile.
+    Every hook is called with the StageProfile of each stage as it ends, e.g. to send it to a monitoring system.
+    Memory is measured with tracemalloc when track_memory is set, which slows the pipeline down.
+    """
+    def __init__(self, hooks=(), track_memory=False):
+        self.hooks = list(hooks)
+        self.track_memory = track_memory
+        self.profile = Profile()
+        self._stack = []
+        self._started_tracing = False
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def _update_peaks(self):
+        # tracemalloc only has one peak, reset at the start of every stage: the peak reached until then
+        # is propagated to the stages still running before the reset
+        _, peak = tracemalloc.get_traced_memory()
+        for _, memory in self._stack:
+            memory[1] = max(memory[1], peak)
+
+    @contextmanager
+    def stage(self, name, **info):
+        record = StageProfile(name, self._stack[-1][0].name if self._stack else None, **info)
+        if self.track_memory and not self._stack and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        tracking = self.track_memory and tracemalloc.is_tracing()
+
+        memory = None
+        if tracking:
+            self._update_peaks()
+            current, _ = tracemalloc.get_traced_memory()
+            memory = [current, current]
+            tracemalloc.reset_peak()
+        self._stack.append((record, memory))
+
+        start_wall, start_cpu = perf_counter(), process_time()
+        try:
+            yield record
+        finally:
+            record.wall_time = perf_counter() - start_wall
+            record.cpu_time = process_time() - start_cpu
+            if tracking:
+                self._update_peaks()
+                current, _ = tracemalloc.get_traced_memory()
+                record.peak_memory = memory[1] - memory[0]
+                record.allocated_memory = current - memory[0]
+            self._stack.pop()
+            if self._started_tracing and not self._stack:
+                tracemalloc.stop()
+                self._started_tracing = False
+
+            self.profile.stages.append(record)
+            for hook in self.hooks:
+                hook(record)
@@ -0,0 +1,105 @@
+import numpy as np
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from skimage.color import rgb2lab, deltaE_ciede2000
+from skimage.metrics import structural_similarity
+
+from .haze_removal import HazeRemover
+
+
+def synthetic_depth(shape, near=0.2, far=1.):
+    """Depth increasing linearly from the bottom (near) to the top (far) of the image, as for a ground plane."""
+    h, w = shape[:2]
+    return np.repeat(np.linspace(far, near, h)[:, None], w, axis=1)
+
+
+def synthesize_haze(clean, depth=None, beta=1., atmospheric_light=(0.9, 0.9, 0.9)):
+    """
+    Hazy version of a clean image from the atmospheric scattering model:
+    I = J * t + A * (1 - t), with t = exp(-beta * depth). Returns the hazy image and t.
+    """
+    depth = synthetic_depth(clean.shape) if depth is None else depth
+    transmission = np.exp(-beta * depth)
+    atmospheric_light = np.asarray(atmospheric_light, dtype=clean.dtype)
+    hazy = clean * transmission[:, :, None] + atmospheric_light * (1 - transmission[:, :, None])
+    return hazy.astype(clean.dtype), transmission.astype(clean.dtype)
+
+
+def psnr(images, references, data_range=1.):
+    """PSNR of each image of a (n, ...) stack against the references, vectorized over the stack."""
+    axes = tuple(range(1, images.ndim))
+    mse = np.mean((np.asarray(images, dtype=np.float64) - references) ** 2, axis=axes)
+    return 10 * np.log10(data_range ** 2 / np.maximum(mse, 1e-20))
+
+
+def ciede2000(images, references):
+    """Mean CIEDE2000 color difference of each image of a (n, h, w, 3) stack against the references."""
+    lab = rgb2lab(np.clip(images, 0, 1))
+    lab_references = rgb2lab(np.clip(references, 0, 1))
+    return np.mean(deltaE_ciede2000(lab, lab_references, channel_axis=-1), axis=(1, 2))
+
+
+def ssim(images, references, workers=None):
+    """SSIM of each image of a (n, h, w[, 3]) stack against the references, computed by a pool of threads."""
+    channel_axis = -1 if images.ndim == 4 else None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        scores = executor.map(
+            lambda pair: structural_similarity(pair[0], pair[1], data_range=1., channel_axis=channel_axis),
+            zip(np.asarray(images, dtype=np.float64), np.broadcast_to(references, images.shape).astype(np.float64)),
+        )
+        return np.array(list(scores))
+
+
+def score(radiances, transmissions, clean, true_transmission, workers=None):
+    """
+    Quality metrics of stacks of dehazed radiances (n, h, w, 3) and estimated transmissions (n, h, w)
+    against the ground truth: PSNR and SSIM of both, and CIEDE2000 of the radiances. Returns a dict of arrays.
+    """
+    radiances, transmissions = np.asarray(radiances), np.asarray(transmissions)
+    return {
+        "radiance_psnr": psnr(radiances, clean),
+        "radiance_ssim": ssim(radiances, clean, workers),
+        "radiance_ciede2000": ciede2000(radiances, np.broadcast_to(clean, radiances.shape)),
+        "transmission_psnr": psnr(transmissions, true_transmission),
+        "transmission_ssim": ssim(transmissions, true_transmission, workers),
+    }
+
+
+def evaluate_quality(clean, configurations, depth=None, beta=1., atmospheric_light=(0.9, 0.9, 0.9), gamma=1., workers=None):
+    """
+    Dehazes a hazy image synthesized from clean with every configuration (name -> HazeRemover keyword arguments),
+    and scores each of them against the ground truth. Returns a list of dicts with the name, time and metrics
+    of each configuration, plus the scores of the hazy image itself (as "hazy") as a reference.
+    The exposure correction is disabled by default (gamma=1) so that the radiance is comparable to clean.
+    """
+    hazy, true_transmission = synthesize_haze(clean, depth, beta, atmospheric_light)
+
+    names = list(configurations)
+    radiances, transmissions, times = [], [], []
+    for name in names:
+        kwargs = {"print_intermediate": False, **configurations[name]}
+        # Warm-up on a crop, so that the times do not include the compilation of the numba kernels
+        HazeRemover(hazy[:64, :64], **kwargs).remove_haze(gamma)
+        start = perf_counter()
+        radiance, transmission, _ = HazeRemover(hazy, **kwargs).remove_haze(gamma)
+        times.append(perf_counter() - start)
+        radiances.append(radiance.astype(np.float64))
+        transmissions.append(transmission.astype(np.float64))
+
+    # The hazy image is scored as a baseline, with the transmission of the model at t = 1
+    radiances.append(hazy.astype(np.float64))
+    transmissions.append(np.ones_like(true_transmission, dtype=np.float64))
+    scores = score(np.stack(radiances), np.stack(transmissions), clean.astype(np.float64), true_transmission.astype(np.float64), workers)
+
+    return [
+        {"name": name, "time": time, **{metric: float(values[i]) for metric, values in scores.items()}}
+        for i, (name, time) in enumerate(zip(names + ["hazy"], times + [0.]))
+    ]
+
+
+def format_quality_table(results):
+    lines = ["{:<24}{:>9}{:>10}{:>9}{:>11}{:>10}{:>9}".format("configuration", "time (s)", "PSNR", "SSIM", "CIEDE2000", "t PSNR", "t SSIM")]
+    for r in results:
+        lines.append("{:<24}{:>9.3f}{:>10.2f}{:>9.4f}{:>11.2f}{:>10.2f}{:>9.4f}".format(
+            r["name"], r["time"], r["radiance_psnr"], r["radiance_ssim"], r["radiance_ciede2000"], r["transmission_psnr"], r["transmission_ssim"]))
+    return "\n".join(lines)
@@ -0,0 +1,80 @@
+import numpy as np
+from numba import njit, prange, float32, float64
+
+
+# Radiance recovery J = (I - A) / max(t, t0) + A, clipping to [0, 1] and gamma correction J ** gamma
+# fused in a single pass over the image, writing to one output array and counting the clipped values.
+# The gamma correction reads a lookup table instead of computing powers when lut is not empty.
+
+@njit([(t[:, :, :], t[:, :], t[:], t, t, t[:], t[:, :, :]) for t in (float32, float64)], parallel=True, cache=True)
+def _recover_radiance(image, transmission, atmospheric_light, t0, gamma, lut, out):
+    h, w, k = image.shape
+    n = lut.shape[0]
+    # Clipped values of each row, summed once the rows are processed in parallel
+    below = np.zeros(h, dtype=np.int64)
+    above = np.zeros(h, dtype=np.int64)
+    for x in prange(h):
+        for y in range(w):
+            t = max(transmission[x, y], t0)
+            for c in range(k):
+                a = atmospheric_light[c]
+                v = (image[x, y, c] - a) / t + a
+                if v < 0:
+                    v = 0
+                    below[x] += 1
+                elif v > 1:
+                    v = 1
+                    above[x] += 1
+                if n > 0:
+                    # Linear interpolation between the entries of the table
+                    p = v * (n - 1)
+                    i = min(int(p), n - 2)
+                    v = lut[i] + (p - i) * (lut[i + 1] - lut[i])
+                elif gamma != 1:
+                    v = v ** gamma
+                out[x, y, c] = v
+    return below.sum(), above.sum()
+
+
+@njit([(t[:, :], t[:, :]) for t in (float32, float64)], parallel=True, cache=True)
+def _clip_unit(array, out):
+    h, w = array.shape
+    clipped = np.zeros(h, dtype=np.int64)
+    for x in prange(h):
+        for y in range(w):
+            v = array[x, y]
+            if v < 0:
+                v = 0
+                clipped[x] += 1
+            elif v > 1:
+                v = 1
+                clipped[x] += 1
+            out[x, y] = v
+    return clipped.sum()
+
+
+def gamma_lut(gamma, size=4096, dtype=np.float64):
+    """Lookup table of v ** gamma over size values evenly spaced in [0, 1], e.g. 256 for 8-bit outputs."""
+    return np.linspace(0, 1, size, dtype=dtype) ** gamma
+
+
+def recover_radiance(image, transmission, atmospheric_light, t0, gamma=1, lut=None, out=None):
+    """
+    Radiance of image (h, w, 3) clipped to [0, 1] and gamma corrected, written to out (allocated if None)
+    in a single pass, with lut an optional table of gamma_lut. Returns out and the numbers of values
+    clipped below 0 and above 1. out sets the type of the computations (the one of image by default).
+    """
+    dtype = image.dtype if out is None else out.dtype
+    out = np.empty(image.shape, dtype=dtype) if out is None else out
+    lut = np.empty(0, dtype=dtype) if lut is None else np.asarray(lut, dtype=dtype)
+    below, above = _recover_radiance(
+        np.asarray(image, dtype=dtype), np.asarray(transmission, dtype=dtype),
+        np.asarray(atmospheric_light, dtype=dtype).ravel(), dtype.type(t0), dtype.type(gamma), lut, out,
+    )
+    return out, int(below), int(above)
+
+
+def clip_unit(array, out=None):
+    """Clips a 2d array to [0, 1] into out (which can be array itself), returning out and the number of clipped values."""
+    out = np.empty_like(array) if out is None else out
+    return out, int(_clip_unit(array, out))
@@ -0,0 +1,317 @@
+import json
+import inspect
+import logging
+import threading
+import numpy as np
+import cv2
+from time import perf_counter
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+
+from .batch import warm_up
+from .constants import GAMMA
+from .batched import BatchedHazeRemover
+from .haze_removal import HazeRemover
+from .io import from_buffer, to_uint8, decode_image as decode_buffer
+
+
+logger = logging.getLogger(__name__)
+
+
+# Parameters of HazeRemover that can be overridden per request, with the type of their values
+OVERRIDABLE_PARAMETERS = {
+    "patch_size": int, "omega": float, "t0": float, "lambd": float, "eps_sm": float, "eps_gf": float, "r": int,
+    "opaque": float, "window_size": int, "use_soft_matting": bool, "guided_image_filtering": bool,
+    "fast_guide_filter": bool, "box_filter": bool, "color_guide": bool, "solver": str, "warm_start": bool,
+    "matrix_free_laplacian": bool, "atmospheric_light_method": str, "gamma": float, "gamma_lut_size": int,
+    "pyramid_size": int, "laplacian_boundary": bool,
+}
+
+
+def parse_parameters(query):
+    """HazeRemover keyword arguments (and gamma) from the parameters of a query string."""
+    parameters = {}
+    for name, value in parse_qsl(query):
+        if name in ("format", "output"):
+            continue
+        if name not in OVERRIDABLE_PARAMETERS:
+            raise ValueError(f"Unknown parameter: {name}")
+        kind = OVERRIDABLE_PARAMETERS[name]
+        parameters[name] = value.lower() in ("1", "true", "yes") if kind is bool else kind(value)
+    return parameters
+
+
+def size_class(shape, granularity=256):
+    """Requests whose images have the same size class (and parameters) are batched together."""
+    return tuple(-(-s // granularity) for s in shape[:2])
+
+
+def decode_image(body, headers):
+    """
+    RGB image from a request body: an encoded image (PNG, JPEG...), or raw pixels when the X-Shape header
+    ("h,w,3") is given, of type X-Dtype (uint8 by default, or float32 in [0, 1]).
+    """
+    if headers.get("X-Shape"):
+        shape = tuple(int(s) for s in headers["X-Shape"].split(","))
+        return from_buffer(body, shape, headers.get("X-Dtype", "uint8"))
+    return decode_buffer(body)
+
+
+def encode_image(image, format="png"):
+    """Body and content type of a response: an 8-bit PNG, or the raw float32 values."""
+    if format == "raw":
+        return np.ascontiguousarray(image, dtype=np.float32).tobytes(), "application/octet-stream"
+    if format != "png":
+        raise ValueError(f"Unknown format: {format}")
+    image = to_uint8(image)
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=image)
+    return cv2.imencode(".png", image)[1].tobytes(), "image/png"
+
+
+def batchable(images, haze_remover_kwargs):
+    """Whether a batch can be dehazed as one stack by BatchedHazeRemover: same shapes, no soft matting."""
+    return (
+        len(images) > 1 and len({image.shape for image in images}) == 1
+        and not haze_remover_kwargs.get("use_soft_matting", True) and haze_remover_kwargs.get("box_filter", True)
+        and haze_remover_kwargs.get("pyramid_size") is None and haze_remover_kwargs.get("gamma_lut_size") is None
+    )
+
+
+def process_batch(images, haze_remover_kwargs):
+    """Dehazes a batch of images in a worker process, returning (radiance, transmission) pairs in float32."""
+    parameters = {**haze_remover_kwargs}
+    gamma = parameters.pop("gamma", GAMMA)
+    if batchable(images, parameters):
+        batched_parameters = {k: v for k, v in parameters.items() if k in inspect.signature(BatchedHazeRemover).parameters}
+        radiances, transmissions, _ = BatchedHazeRemover(np.stack(images), **batched_parameters).remove_haze(gamma)
+        return [(radiance.astype(np.float32), transmission.astype(np.float32)) for radiance, transmission in zip(radiances, transmissions)]
+    results = []
+    for image in images:
+        radiance, transmission, _ = HazeRemover(image, **parameters, print_intermediate=False).remove_haze(gamma)
+        results.append((radiance.astype(np.float32), transmission.astype(np.float32)))
+    return results
+
+
+class DehazingServer:
+    """
+    Dehazing service: requests are queued by size class and parameters, and flushed as batches to a pool
+    of worker processes, which compile the kernels once when they start. A batch is sent when it reaches
+    max_batch_size requests or when its oldest request has waited for max_delay seconds, and is dehazed
+    as one stack (see BatchedHazeRemover) when its images have the same shape and no soft matting is used.
+    Keyword arguments are the default HazeRemover parameters (and gamma), overridable per request.
+    If a worker dies (e.g. killed when out of memory), its batches fail and the pool is recreated;
+    requests not answered within request_timeout seconds get a 503 response.
+    """
+    def __init__(self, workers=None, max_batch_size=4, max_delay=0.01, size_granularity=256, latency_window=1000, request_timeout=60, **haze_remover_kwargs):
+        self.workers = workers
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.size_granularity = size_granularity
+        self.request_timeout = request_timeout
+        self.haze_remover_kwargs = haze_remover_kwargs
+        # The workers are started (forked) now from the calling thread rather than later from the batching thread,
+        # and the server is ready once they have compiled the kernels
+        self.executor = self._start_executor()
+        self.executor_broken = False
+        self.healthy = True
+
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.in_flight = 0
+        self.latencies = deque(maxlen=latency_window)
+        self.counters = {"completed": 0, "failed": 0, "batches": 0, "batched_requests": 0, "pool_restarts": 0}
+        self.closed = False
+        self.batcher = threading.Thread(target=self._batching_loop, daemon=True)
+        self.batcher.start()
+
+    def submit(self, image, **parameters):
+        """Future of the (radiance, transmission) of image, dehazed with the given parameter overrides."""
+        parameters = {**self.haze_remover_kwargs, **parameters}
+        key = (size_class(image.shape, self.size_granularity), tuple(sorted(parameters.items())))
+        future = Future()
+        with self.condition:
+            self.pending.setdefault(key, []).append((image, future, perf_counter()))
+            self.condition.notify()
+        return future
+
+    def _start_executor(self):
+        default_kwargs = {k: v for k, v in self.haze_remover_kwargs.items() if k in inspect.signature(HazeRemover).parameters}
+        executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up, initargs=(default_kwargs,))
+        executor.submit(int).result()
+        return executor
+
+    def _restart_executor(self):
+        # Called by the batching thread, holding the condition
+        logger.warning("A worker process died, restarting the pool of workers")
+        self.executor.shutdown(wait=False)
+        try:
+            self.executor = self._start_executor()
+        except Exception as error:
+            logger.error(f"Could not restart the pool of workers: {error}")
+            self.healthy = False
+            return
+        self.executor_broken = False
+        self.healthy = True
+        self.counters["pool_restarts"] += 1
+
+    def _batching_loop(self):
+        with self.condition:
+            while not self.closed:
+                if self.executor_broken:
+                    self._restart_executor()
+                now = perf_counter()
+                timeout = None
+                for key in list(self.pending):
+                    requests = self.pending[key]
+                    wait = requests[0][2] + self.max_delay - now
+                    if len(requests) >= self.max_batch_size or wait <= 0:
+                        batch, self.pending[key] = requests[:self.max_batch_size], requests[self.max_batch_size:]
+                        if not self.pending[key]:
+                            del self.pending[key]
+                        self._send_batch(batch, dict(key[1]))
+                    else:
+                        timeout = wait if timeout is None else min(timeout, wait)
+                if not any(len(r) >= self.max_batch_size for r in self.pending.values()):
+                    self.condition.wait(timeout)
+
+    def _send_batch(self, batch, parameters):
+        self.in_flight += len(batch)
+        self.counters["batches"] += 1
+        self.counters["batched_requests"] += len(batch)
+        try:
+            task = self.executor.submit(process_batch, [image for image, _, _ in batch], parameters)
+        except Exception as error:
+            # BrokenProcessPool if a worker died since the last batch, the pool is recreated for the next ones
+            self.executor_broken = isinstance(error, BrokenProcessPool)
+            self.in_flight -= len(batch)
+            self._fail_batch(batch, error)
+            return
+        task.add_done_callback(lambda task: self._complete_batch(task, batch))
+
+    def _fail_batch(self, batch, error):
+        self.counters["failed"] += len(batch)
+        for _, future, _ in batch:
+            future.set_exception(error)
+
+    def _complete_batch(self, task, batch):
+        end = perf_counter()
+        error = task.exception()
+        with self.condition:
+            self.in_flight -= len(batch)
+            self.counters["failed" if error else "completed"] += len(batch)
+            self.latencies.extend(end - start for _, _, start in batch)
+            if isinstance(error, BrokenProcessPool):
+                self.executor_broken = True
+                self.condition.notify()
+        for index, (_, future, _) in enumerate(batch):
+            if error is None:
+                future.set_result(task.result()[index])
+            else:
+                future.set_exception(error)
+
+    def is_healthy(self):
+        """Whether requests can be served: the batching thread runs and the pool of workers could be (re)started."""
+        with self.condition:
+            return self.healthy and self.batcher.is_alive()
+
+    def stats(self):
+        with self.condition:
+            latencies = np.array(self.latencies)
+            queued = sum(len(requests) for requests in self.pending.values())
+            stats = {
+                "queue_depth": queued + self.in_flight,
+                "queued": queued,
+                "in_flight": self.in_flight,
+                **self.counters,
+                "mean_batch_size": self.counters["batched_requests"] / max(1, self.counters["batches"]),
+            }
+        stats["healthy"] = self.is_healthy()
+        for percentile in (50, 90, 99):
+            stats[f"latency_p{percentile}"] = float(np.percentile(latencies, percentile)) if len(latencies) else None
+        return stats
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.batcher.join()
+        self.executor.shutdown()
+
+    def serve(self, host="127.0.0.1", port=8000):
+        """Serves POST /dehaze and GET /stats over HTTP until interrupted."""
+        http_server = ThreadingHTTPServer((host, port), DehazingRequestHandler)
+        http_server.dehazing_server = self
+        logger.info(f"Serving on http://{host}:{port}")
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            http_server.server_close()
+            self.close()
+
+
+class DehazingRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /dehaze?output=radiance|transmission&format=png|raw&<HazeRemover parameter>=<value>...
+    with an encoded image or raw pixels (see decode_image) as body. Raw responses have X-Shape and X-Dtype headers.
+    GET /stats returns the queue depth, counters and latency percentiles as JSON,
+    GET /health a 503 status when the server cannot serve requests.
+    """
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send(status, json.dumps({"error": message}).encode(), "application/json")
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/stats":
+            self._send(200, json.dumps(self.server.dehazing_server.stats()).encode(), "application/json")
+        elif path == "/health":
+            if self.server.dehazing_server.is_healthy():
+                self._send(200, b"ok", "text/plain")
+            else:
+                self._send(503, b"unhealthy", "text/plain")
+        else:
+            self._send_error(404, f"Unknown path: {path}")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/dehaze":
+            return self._send_error(404, f"Unknown path: {url.path}")
+        query = dict(parse_qsl(url.query))
+        output, format = query.get("output", "radiance"), query.get("format", "png")
+        try:
+            if output not in ("radiance", "transmission"):
+                raise ValueError(f"Unknown output: {output}")
+            parameters = parse_parameters(url.query)
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            image = decode_image(body, self.headers)
+        except ValueError as error:
+            return self._send_error(400, str(error))
+
+        dehazing_server = self.server.dehazing_server
+        try:
+            radiance, transmission = dehazing_server.submit(image, **parameters).result(timeout=dehazing_server.request_timeout)
+        except TimeoutError:
+            return self._send_error(503, f"No response within {dehazing_server.request_timeout}s")
+        except Exception as error:
+            return self._send_error(500, str(error))
+        result = radiance if output == "radiance" else transmission
+        body, content_type = encode_image(result, format)
+        headers = {"X-Shape": ",".join(map(str, result.shape)), "X-Dtype": "float32"} if format == "raw" else None
+        self._send(200, body, content_type, headers)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
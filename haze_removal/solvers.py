@@ -0,0 +1,136 @@
+import numpy as np
+import cv2
+from time import time
+from scipy.sparse import kron, csr_matrix, issparse
+from scipy.sparse.linalg import cg, splu, LinearOperator
+
+from .constants import SOLVER, SOLVER_TOL, SOLVER_MAXITER
+
+
+def _conjugate_gradient(A, b, x0, M, tol, maxiter, callback):
+    try:
+        return cg(A, b, x0=x0, M=M, maxiter=maxiter, rtol=tol, callback=callback)
+    except TypeError:
+        # scipy < 1.12 names the relative tolerance `tol`
+        return cg(A, b, x0=x0, M=M, maxiter=maxiter, tol=tol, callback=callback)
+
+
+def jacobi_preconditioner(A):
+    inv_diagonal = 1.0 / A.diagonal()
+    return LinearOperator(A.shape, matvec=lambda x: inv_diagonal * x.ravel(), dtype=A.dtype)
+
+
+# ========= GEOMETRIC MULTIGRID =================
+def interpolation_1d(n, dtype=np.float64):
+    """
+    Linear interpolation from ceil(n/2) coarse points to n fine points, as a (n, ceil(n/2)) sparse matrix.
+    Even fine points are injected from the coarse grid, odd ones are averaged from their two neighbours.
+    """
+    n_coarse = (n + 1) // 2
+    fine = np.arange(n)
+    left = fine // 2
+    right = np.minimum(left + fine % 2, n_coarse - 1)
+
+    rows = np.concatenate([fine, fine])
+    cols = np.concatenate([left, right])
+    values = np.full(2 * n, 0.5)
+    return csr_matrix((values, (rows, cols)), shape=(n, n_coarse), dtype=dtype)
+
+
+class MultigridPreconditioner:
+    """
+    Symmetric V-cycle on the pixel grid, with Galerkin coarse operators P^T A P,
+    bilinear prolongation, weighted Jacobi smoothing and a direct solve on the coarsest level.
+    Can be used as the preconditioner M of the conjugate gradient.
+    """
+    def __init__(self, A, shape, max_coarse_size=4096, smoothing_steps=2, omega=2/3):
+        self.smoothing_steps = smoothing_steps
+        self.omega = omega
+        self.operators = [A.tocsr()]
+        self.prolongations = []
+
+        h, w = shape
+        while h * w > max_coarse_size and min(h, w) > 2:
+            P = kron(interpolation_1d(h, A.dtype), interpolation_1d(w, A.dtype), format='csr')
+            self.prolongations.append(P)
+            self.operators.append((P.T @ self.operators[-1] @ P).tocsr())
+            h, w = (h + 1) // 2, (w + 1) // 2
+
+        self.inv_diagonals = [1.0 / operator.diagonal() for operator in self.operators]
+        self.coarse_solver = splu(self.operators[-1].tocsc())
+
+    def smooth(self, level, x, b):
+        A, inv_diagonal = self.operators[level], self.inv_diagonals[level]
+        for _ in range(self.smoothing_steps):
+            x += self.omega * inv_diagonal * (b - A @ x)
+        return x
+
+    def v_cycle(self, b, level=0):
+        if level == len(self.operators) - 1:
+            return self.coarse_solver.solve(b)
+
+        A, P = self.operators[level], self.prolongations[level]
+        x = self.smooth(level, np.zeros_like(b), b)
+        x += P @ self.v_cycle(P.T @ (b - A @ x), level + 1)
+        return self.smooth(level, x, b)
+
+    def as_linear_operator(self):
+        A = self.operators[0]
+        return LinearOperator(A.shape, matvec=lambda b: self.v_cycle(b.ravel()), dtype=A.dtype)
+
+
+# ========= SOLVER LAYER =================
+def build_preconditioner(A, shape, solver):
+    if solver == "jacobi":
+        return jacobi_preconditioner(A)
+    if solver == "multigrid":
+        if not issparse(A):
+            raise ValueError("The multigrid solver needs an explicit matrix, use the jacobi solver with a matrix-free laplacian")
+        return MultigridPreconditioner(A, shape).as_linear_operator()
+    raise ValueError(f"Unknown soft matting solver: {solver}")
+
+
+def solve_linear_system(A, b, shape, solver=SOLVER, x0=None, tol=SOLVER_TOL, maxiter=SOLVER_MAXITER, M=None):
+    """
+    Solves A x = b with a preconditioned conjugate gradient, where the unknowns live on a grid of the given shape.
+    M is the preconditioner of build_preconditioner(A, shape, solver), built if None (it can be reused to solve
+    systems with the same matrix). Returns the solution and the convergence statistics of the solve.
+    """
+    start = time()
+    M = build_preconditioner(A, shape, solver) if M is None else M
+    setup_time = time() - start
+
+    iterations = [0]
+    def count_iteration(_):
+        iterations[0] += 1
+
+    x, info = _conjugate_gradient(A, b, x0, M, tol, maxiter, count_iteration)
+    stats = {
+        "solver": solver,
+        "converged": info == 0,
+        "iterations": iterations[0],
+        "residual": float(np.linalg.norm(b - A @ x) / np.linalg.norm(b)),
+        "setup_time": setup_time,
+        "time": time() - start,
+    }
+    return x, stats
+
+
+def coarse_to_fine_initial_guess(image, transmission, compute_system, solver=SOLVER, scale_factor=2, min_size=64):
+    """
+    Solves the soft matting system on a downsampled image and upsamples the matte,
+    to be used as the initial guess of the full resolution solve.
+    compute_system(image, transmission) must return the matrix and right-hand side of the system.
+    """
+    h, w = image.shape[:2]
+    hs, ws = h // scale_factor, w // scale_factor
+    if min(hs, ws) < min_size:
+        return None, None
+
+    image_small = cv2.resize(image, (ws, hs), interpolation=cv2.INTER_AREA)
+    transmission_small = cv2.resize(transmission, (ws, hs), interpolation=cv2.INTER_AREA)
+
+    A, b = compute_system(image_small, transmission_small)
+    x_small, stats = solve_linear_system(A, b, (hs, ws), solver=solver)
+    x0 = cv2.resize(x_small.reshape((hs, ws)), (w, h), interpolation=cv2.INTER_LINEAR)
+    return x0.ravel(), stats
@@ -0,0 +1,118 @@
+import inspect
+import itertools
+import numpy as np
+from time import time
+
+from .constants import GAMMA
+from .haze_removal import HazeRemover
+
+
+# Pipeline stages in order, with the parameters each of them adds to its upstream dependencies
+STAGES = [
+    ("dark_channel", ("patch_size", "dtype")),
+    ("atmospheric_light", ("opaque", "atmospheric_light_method", "atmospheric_light", "pyramid_size")),
+    ("raw_transmission", ("omega",)),
+    ("refined_transmission", (
+        "use_soft_matting", "guided_image_filtering", "fast_guide_filter", "box_filter", "color_guide",
+        "window_size", "eps_gf", "eps_sm", "r", "lambd", "solver", "warm_start", "matrix_free_laplacian",
+        "laplacian_boundary",
+    )),
+    ("radiance", ("t0", "gamma", "gamma_lut_size")),
+]
+
+def _default_parameters():
+    signature = inspect.signature(HazeRemover.__init__)
+    defaults = {name: p.default for name, p in signature.parameters.items() if p.default is not inspect.Parameter.empty}
+    return {**defaults, "gamma": GAMMA}
+
+
+def _key_value(value):
+    # Arrays (e.g. a given atmospheric light) are compared by value
+    return tuple(np.ravel(value).tolist()) if isinstance(value, (np.ndarray, list, tuple)) else value
+
+
+class ParameterSweep:
+    """
+    Runs the haze removal pipeline for many parameter values on the same image, recomputing only
+    the stages downstream of the parameters that changed since the previous run:
+    dark channel -> atmospheric light -> raw transmission -> refined transmission -> radiance (with exposure).
+    The result of each stage is kept for the last parameter values it was computed with,
+    so runs are the cheapest when upstream parameters change the least often (see sweep).
+    In pyramid mode (see HazeRemover.pyramid_transmission), the atmospheric light is estimated at the coarse level
+    along with the refined transmission, and the raw transmission stage does nothing.
+    """
+    def __init__(self, image, **parameters):
+        self.image = image
+        self.parameters = {**_default_parameters(), **parameters, "print_intermediate": False}
+        self.cache = {}
+        self.computations = {name: 0 for name, _ in STAGES}
+        self.times = {name: 0. for name, _ in STAGES}
+
+    def _compute_stage(self, name, haze_remover, gamma):
+        if name == "dark_channel":
+            return haze_remover.compute_dark_channel()
+        if name == "atmospheric_light":
+            # Only estimated when it is not given
+            if haze_remover.atmospheric_light is None and not haze_remover.uses_pyramid:
+                haze_remover.compute_atmospheric_light()
+            return haze_remover.atmospheric_light
+        if name == "raw_transmission":
+            if haze_remover.uses_pyramid:
+                return None
+            haze_remover.compute_transmission()
+            return haze_remover.transmission
+        if name == "refined_transmission":
+            if haze_remover.uses_pyramid:
+                haze_remover.pyramid_transmission()
+            else:
+                haze_remover.refine_transmission()
+            return haze_remover.transmission, haze_remover.atmospheric_light
+        haze_remover.compute_radiance(gamma=gamma)
+        return haze_remover.radiance
+
+    def _restore_stage(self, name, haze_remover, value):
+        if name == "dark_channel":
+            haze_remover.dark_channel = value
+        elif name == "atmospheric_light":
+            haze_remover.atmospheric_light = value
+        elif name == "raw_transmission":
+            haze_remover.transmission = value
+        elif name == "refined_transmission":
+            haze_remover.transmission, haze_remover.atmospheric_light = value
+        else:
+            haze_remover.radiance = value
+
+    def run(self, **parameters):
+        """Returns radiance, transmission and atmospheric light for the given parameters."""
+        parameters = {**self.parameters, **parameters}
+        gamma = parameters.pop("gamma")
+        haze_remover = HazeRemover(self.image, **parameters)
+        parameters["gamma"] = gamma
+
+        key = ()
+        for name, stage_parameters in STAGES:
+            key += tuple(_key_value(parameters[p]) for p in stage_parameters)
+            cached_key, value = self.cache.get(name, (None, None))
+            if cached_key == key:
+                self._restore_stage(name, haze_remover, value)
+            else:
+                start = time()
+                value = self._compute_stage(name, haze_remover, gamma)
+                self.times[name] += time() - start
+                self.computations[name] += 1
+                self.cache[name] = (key, value)
+
+        transmission = self.cache["refined_transmission"][1][0]
+        return haze_remover.radiance, transmission, haze_remover.atmospheric_light
+
+    def sweep(self, grid):
+        """
+        Generator of (parameters, radiance, transmission, atmospheric_light) over the cartesian product
+        of grid, a dict of parameter name -> list of values. The loops are nested so that parameters
+        of upstream stages vary the least often.
+        """
+        order = [p for _, stage_parameters in STAGES for p in stage_parameters]
+        names = sorted(grid, key=lambda p: order.index(p) if p in order else -1)
+        for values in itertools.product(*(grid[name] for name in names)):
+            parameters = dict(zip(names, values))
+            yield (parameters,) + self.run(**parameters)
@@ -0,0 +1,111 @@
+import logging
+import numpy as np
+from time import time
+from warnings import warn
+
+from .constants import PATCH_SIZE, OPAQUE
+from .haze_removal import HazeRemover, default_window_size
+from .utils import to_float_image
+
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_atmospheric_light(image, max_size=1024, patch_size=PATCH_SIZE, opaque=OPAQUE, method="dark_channel"):
+    """
+    Atmospheric light of the whole image, estimated on a strided subsample
+    whose largest side is at most max_size.
+    """
+    stride = int(np.ceil(max(image.shape[:2]) / max_size))
+    image_small = to_float_image(image[::stride, ::stride, :3])
+    haze_remover = HazeRemover(image_small, patch_size=max(1, patch_size // stride), opaque=opaque, atmospheric_light_method=method, print_intermediate=False)
+    haze_remover.compute_atmospheric_light()
+    return haze_remover.atmospheric_light
+
+
+def _blending_ramp(length, overlap):
+    ramp = np.ones(length)
+    if overlap > 0:
+        ramp[:overlap] = np.arange(1, overlap + 1) / (overlap + 1)
+    return ramp
+
+
+class TiledHazeRemover:
+    """
+    Removes haze tile by tile, so that the memory used only depends on the tile size.
+    The atmospheric light is estimated once for the whole image, each tile is processed with a halo
+    of surrounding pixels which is cropped afterwards, and neighbouring tiles are linearly blended
+    over `blend` pixels. image can be a memory-mapped array (see io.open_image_lazy) of floats or integers,
+    and the outputs memory-mapped arrays (see io.open_output_array).
+    Tiles are refined with the exact guided filter: the fast guided filter downsamples each tile on its own grid,
+    which leaves seams between the tiles. With guided filtering the tiled result is then the one of HazeRemover
+    with fast_guide_filter=False (and the same atmospheric light), soft matting only approaches it.
+    """
+    def __init__(self, image, tile_size=512, halo=None, blend=16, **haze_remover_kwargs):
+        self.image = image
+        self.tile_size = tile_size
+        self.blend = blend
+        # Given to every tile by remove_haze
+        self.atmospheric_light = haze_remover_kwargs.pop("atmospheric_light", None)
+        if haze_remover_kwargs.get("fast_guide_filter"):
+            warn("The fast guided filter is not available by tiles, using the exact guided filter")
+        self.haze_remover_kwargs = {**haze_remover_kwargs, "fast_guide_filter": False}
+
+        patch_size = haze_remover_kwargs.get("patch_size", PATCH_SIZE)
+        window_size = haze_remover_kwargs.get("window_size")
+        self.window_size = default_window_size(image.shape) if window_size is None else window_size
+        self.halo = patch_size + self.window_size + blend if halo is None else halo
+
+    def tiles(self):
+        h, w = self.image.shape[:2]
+        for y0 in range(0, h, self.tile_size):
+            for x0 in range(0, w, self.tile_size):
+                yield y0, min(h, y0 + self.tile_size), x0, min(w, x0 + self.tile_size)
+
+    def remove_haze(self, correct_exposition=1, radiance_out=None, transmission_out=None):
+        start = time()
+        h, w = self.image.shape[:2]
+
+        if self.atmospheric_light is None:
+            logger.info("Computing atmospheric light...")
+            self.atmospheric_light = estimate_atmospheric_light(
+                self.image,
+                patch_size=self.haze_remover_kwargs.get("patch_size", PATCH_SIZE),
+                opaque=self.haze_remover_kwargs.get("opaque", OPAQUE),
+                method=self.haze_remover_kwargs.get("atmospheric_light_method", "dark_channel"),
+            )
+
+        dtype = self.haze_remover_kwargs.get("dtype", np.float64)
+        radiance_out = np.empty((h, w, 3), dtype=dtype) if radiance_out is None else radiance_out
+        transmission_out = np.empty((h, w), dtype=dtype) if transmission_out is None else transmission_out
+
+        tiles = list(self.tiles())
+        for index, (y0, y1, x0, x1) in enumerate(tiles):
+            logger.info(f"Processing tile {index + 1}/{len(tiles)}...")
+            # Region written to the output, overlapping the tiles above and on the left
+            wy0, wx0 = max(0, y0 - self.blend), max(0, x0 - self.blend)
+            # Region processed, including the halo
+            cy0, cy1 = max(0, wy0 - self.halo), min(h, y1 + self.halo)
+            cx0, cx1 = max(0, wx0 - self.halo), min(w, x1 + self.halo)
+
+            haze_remover = HazeRemover(
+                self.image[cy0:cy1, cx0:cx1, :3],
+                **{**self.haze_remover_kwargs, "window_size": self.window_size, "print_intermediate": False},
+                atmospheric_light=self.atmospheric_light,
+            )
+            radiance, transmission, _ = haze_remover.remove_haze(correct_exposition)
+            radiance = radiance[wy0 - cy0:y1 - cy0, wx0 - cx0:x1 - cx0]
+            transmission = transmission[wy0 - cy0:y1 - cy0, wx0 - cx0:x1 - cx0]
+
+            weights = np.outer(_blending_ramp(y1 - wy0, y0 - wy0), _blending_ramp(x1 - wx0, x0 - wx0))
+            overlap = weights < 1
+            weights = weights[overlap]
+            transmission[overlap] = weights * transmission[overlap] + (1 - weights) * transmission_out[wy0:y1, wx0:x1][overlap]
+            radiance[overlap] = weights[:, None] * radiance[overlap] + (1 - weights[:, None]) * radiance_out[wy0:y1, wx0:x1][overlap]
+
+            transmission_out[wy0:y1, wx0:x1] = transmission
+            radiance_out[wy0:y1, wx0:x1] = radiance
+
+        logger.info("Took {:2f}s to perform tiled haze removal".format(time() - start))
+
+        return radiance_out, transmission_out, self.atmospheric_light
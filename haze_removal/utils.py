@@ -1,19 +1,31 @@
+import logging
 import os
-import matplotlib.pyplot as plt
-from skimage.io import imread
-from skimage.transform import resize
-
-
-def load_image(path, maxwh=400, show_image=True):
-    print(f"Loading image from {path}")
-    image = imread(path) / 255
-    h, w = image.shape[:2]
-    if max(h, w) > maxwh:
-        if h > w:
-            image = resize(image, (maxwh, int(w*maxwh/h)))
-        else:
-            image = resize(image, (int(h*maxwh/w), maxwh))
+import numpy as np
+
+from .io import open_image_lazy, resize_image
+
+
+logger = logging.getLogger(__name__)
+
+
+def to_float_image(image, dtype=np.float64, out=None):
+    # Integer images (e.g. uint8) are scaled to [0, 1], into out if given
+    if np.issubdtype(image.dtype, np.integer):
+        return np.multiply(image, 1 / np.iinfo(image.dtype).max, dtype=dtype, out=out)
+    if out is not None:
+        np.copyto(out, image)
+        return out
+    return np.asarray(image, dtype=dtype)
+
+
+# matplotlib is imported when first needed, as it makes `import haze_removal` much slower
+
+def load_image(path, maxwh=400, show_image=True, dtype=np.float64):
+    logger.info(f"Loading image from {path}")
+    # The image is resized before its conversion to floats
+    image = to_float_image(resize_image(open_image_lazy(path), maxwh), dtype)
     if show_image:
+        import matplotlib.pyplot as plt
         plt.imshow(image)
         plt.axis('off')
         plt.title('Initial image')
@@ -22,6 +34,7 @@ def load_image(path, maxwh=400, show_image=True):
 
 
 def show_imgs(imgs, figsize=(20,10)):
+    import matplotlib.pyplot as plt
     plt.figure(figsize=figsize)
     for ind, img in enumerate(imgs):
         plt.subplot(len(imgs)//3 + 1, len(imgs) % 3 + 1, ind+1)
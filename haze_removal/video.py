@@ -0,0 +1,199 @@
+import logging
+import threading
+import numpy as np
+import cv2
+from queue import Queue, Full
+from time import time
+
+from .haze_removal import HazeRemover
+
+
+logger = logging.getLogger(__name__)
+
+
+_END = object()
+
+
+class _Error:
+    # Exception raised while iterating, told apart from items which are exceptions themselves
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(iterable, maxsize=4, poll_interval=0.1):
+    """
+    Iterates over iterable in a background thread, keeping up to maxsize items ready.
+    When the consumer stops early (break, exception, close()), the background thread stops within poll_interval
+    seconds (once the item being read is ready) and closes iterable if it is a generator, releasing its resources.
+    """
+    queue = Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        # False if the consumer stopped before the item could be queued
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=poll_interval)
+                return True
+            except Full:
+                pass
+        return False
+
+    def producer():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+            put(_END)
+        except Exception as error:
+            put(_Error(error))
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    threading.Thread(target=producer, daemon=True).start()
+    try:
+        while True:
+            item = queue.get()
+            if item is _END:
+                return
+            if isinstance(item, _Error):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+
+
+def read_video_frames(path):
+    capture = cv2.VideoCapture(path)
+    try:
+        while True:
+            success, frame = capture.read()
+            if not success:
+                return
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) / 255
+    finally:
+        capture.release()
+
+
+class BackgroundVideoWriter:
+    """Encodes RGB float frames to a video file in a background thread."""
+    def __init__(self, path, fps, maxsize=4):
+        self.path = path
+        self.fps = fps
+        self.writer = None
+        self.queue = Queue(maxsize=maxsize)
+        self.thread = threading.Thread(target=self._write_frames, daemon=True)
+        self.thread.start()
+
+    def _write_frames(self):
+        while True:
+            frame = self.queue.get()
+            if frame is _END:
+                break
+            if self.writer is None:
+                h, w = frame.shape[:2]
+                self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*"mp4v"), self.fps, (w, h))
+            self.writer.write(cv2.cvtColor(np.uint8(np.clip(frame, 0, 1) * 255), cv2.COLOR_RGB2BGR))
+        if self.writer is not None:
+            self.writer.release()
+
+    def write(self, frame):
+        self.queue.put(frame)
+
+    def close(self):
+        self.queue.put(_END)
+        self.thread.join()
+
+
+class VideoHazeRemover:
+    """
+    Removes haze from a stream of frames, reusing estimations between frames:
+    - the atmospheric light is only estimated every atmospheric_light_period frames or on a scene cut,
+      and smoothed over time with an exponential moving average of factor atmospheric_light_smoothing
+    - soft matting is warm-started from the transmission of the previous frame
+    - the refined transmission is blended with the previous one with a factor transmission_smoothing,
+      which reduces flickering
+    Other keyword arguments are passed to HazeRemover.
+    """
+    def __init__(self, atmospheric_light_period=30, atmospheric_light_smoothing=0.9, transmission_smoothing=0.5, scene_cut_threshold=0.15, prefetch_size=4, **haze_remover_kwargs):
+        self.atmospheric_light_period = atmospheric_light_period
+        self.atmospheric_light_smoothing = atmospheric_light_smoothing
+        self.transmission_smoothing = transmission_smoothing
+        self.scene_cut_threshold = scene_cut_threshold
+        self.prefetch_size = prefetch_size
+        self.haze_remover_kwargs = {**haze_remover_kwargs, "print_intermediate": False}
+        self.reset()
+
+    def reset(self):
+        self.frame_index = 0
+        self.atmospheric_light = None
+        self.transmission = None
+        self.thumbnail = None
+
+    def is_scene_cut(self, frame):
+        # frame of floats in [0, 1], as scene_cut_threshold
+        thumbnail = cv2.resize(frame, (32, 32), interpolation=cv2.INTER_AREA)
+        is_cut = self.thumbnail is not None and np.mean(np.abs(thumbnail - self.thumbnail)) > self.scene_cut_threshold
+        self.thumbnail = thumbnail
+        return is_cut
+
+    def process_frame(self, frame, correct_exposition=1):
+        haze_remover = HazeRemover(frame, **self.haze_remover_kwargs)
+        # The frame converted to floats by HazeRemover, integer frames (e.g. uint8) would wrap around when compared
+        scene_cut = self.is_scene_cut(haze_remover.image)
+        if scene_cut or self.transmission is not None and self.transmission.shape != frame.shape[:2]:
+            self.frame_index = 0
+            self.atmospheric_light = None
+            self.transmission = None
+
+        if self.atmospheric_light is None or self.frame_index % self.atmospheric_light_period == 0:
+            haze_remover.compute_atmospheric_light()
+            if self.atmospheric_light is None:
+                self.atmospheric_light = haze_remover.atmospheric_light
+            else:
+                s = self.atmospheric_light_smoothing
+                self.atmospheric_light = s * self.atmospheric_light + (1 - s) * haze_remover.atmospheric_light
+        haze_remover.atmospheric_light = self.atmospheric_light
+
+        haze_remover.compute_transmission()
+        haze_remover.refine_transmission(self.transmission)
+        if self.transmission is not None:
+            s = self.transmission_smoothing
+            haze_remover.transmission = s * self.transmission + (1 - s) * haze_remover.transmission
+        self.transmission = haze_remover.transmission
+
+        # Radiance, clipping and exposure in a single pass (with the lookup table of gamma_lut_size if given)
+        haze_remover.compute_radiance(gamma=correct_exposition)
+        self.frame_index += 1
+
+        return haze_remover.radiance, haze_remover.transmission, self.atmospheric_light
+
+    def process(self, frames, correct_exposition=1):
+        """Generator of (radiance, transmission, atmospheric_light), frames being read in a background thread."""
+        frames = prefetch(frames, self.prefetch_size)
+        try:
+            for frame in frames:
+                yield self.process_frame(frame, correct_exposition)
+        finally:
+            # Stops the reading thread (and releases the video) when the caller stops early
+            frames.close()
+
+    def process_video(self, input_path, output_path, correct_exposition=1):
+        capture = cv2.VideoCapture(input_path)
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25
+        capture.release()
+
+        start = time()
+        writer = BackgroundVideoWriter(output_path, fps, self.prefetch_size)
+        n_frames = 0
+        try:
+            for radiance, _, _ in self.process(read_video_frames(input_path), correct_exposition):
+                writer.write(radiance)
+                n_frames += 1
+        finally:
+            writer.close()
+
+        elapsed = time() - start
+        logger.info("Took {:2f}s to process {} frames ({:.1f} fps)".format(elapsed, n_frames, n_frames / max(elapsed, 1e-9)))
@@ -1,8 +1,10 @@
 # python main.py -p ./images/img.jpg --resize 800
 
+import logging
 import argparse
-import matplotlib.pyplot as plt
-from haze_removal import HazeRemover, load_image, create_save_folder_and_get_file_info, get_save_extension, LAMBDA, T0, OMEGA, OPAQUE, GAMMA, PATCH_SIZE
+import numpy as np
+from haze_removal import HazeRemover, TiledHazeRemover, ArrayCache, Profiler, create_save_folder_and_get_file_info, get_save_extension, LAMBDA, T0, OMEGA, OPAQUE, GAMMA, PATCH_SIZE
+from haze_removal.io import open_image_lazy, resize_image, write_image
 
 parser = argparse.ArgumentParser(description="Haze removal function")
 parser.add_argument("--path", "-p", type=str, help="Image path", default=None)
@@ -12,32 +14,61 @@ parser.add_argument("--t0", type=float, default=T0)
 parser.add_argument("--omega", type=float, default=OMEGA)
 parser.add_argument("--opaque", type=float, default=OPAQUE)
 parser.add_argument("--gamma", type=float, default=GAMMA)
+parser.add_argument("--atmospheric_light_method", type=str, choices=["dark_channel", "quadtree"], help="Method to estimate the atmospheric light", default="dark_channel")
+parser.add_argument("--shape", type=int, nargs=3, help="Height, width and channels of a .raw (uint8) image", default=None)
 parser.add_argument("--resize", type=int, help="Size of the largest side", default=1400)
 parser.add_argument("--save_folder", "-s", type=str, help="Folder to save haze-free image in", default="./results/")
 parser.add_argument("--soft_matting", "-m", action='store_true', help="Boolean to use soft matting")
 parser.add_argument("--guided_filtering", "-f", action='store_true', help="Boolean to use guided filtering")
+parser.add_argument("--pyramid", action='store_true', help="Boolean to estimate the transmission on the image resized to --resize and upsample it, keeping the full resolution for the output")
+parser.add_argument("--tile_size", type=int, help="Process the image by tiles of this size to bound memory", default=None)
+parser.add_argument("--float32", action='store_true', help="Boolean to run the whole pipeline in float32 instead of float64")
+parser.add_argument("--cache_dir", type=str, help="Folder to cache the matting laplacians, guided filter coefficients and refined transmissions in", default=None)
+parser.add_argument("--color_guide", action='store_true', help="Boolean to use the color image as guide for guided filtering")
+parser.add_argument("--num_threads", type=int, help="Number of threads of the numba kernels (defaults to the number of CPUs)", default=None)
+parser.add_argument("--profile", action='store_true', help="Boolean to log the time and peak memory of each stage")
+parser.add_argument("--quiet", "-q", action='store_true', help="Boolean to only log warnings")
 args = parser.parse_args()
 
+logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(message)s")
+
 
 name, file_extension, save_folder = create_save_folder_and_get_file_info(args.path, args.save_folder)
 
-image = load_image(args.path, args.resize, show_image=False)
+dtype = np.float32 if args.float32 else np.float64
+# The image is kept in its integer type (memory-mapped for .npy, .raw and .tif files): HazeRemover converts it
+image = open_image_lazy(args.path, args.shape)
+if not args.pyramid:
+    image = resize_image(image, args.resize)
 
 
-haze_remover = HazeRemover(
+profiler = Profiler(track_memory=args.profile)
+haze_remover_class = HazeRemover if args.tile_size is None else TiledHazeRemover
+haze_remover_kwargs = {} if args.tile_size is None else {"tile_size": args.tile_size}
+haze_remover = haze_remover_class(
     image,
+    **haze_remover_kwargs,
     patch_size=args.patch_size,
     use_soft_matting=args.soft_matting,
     guided_image_filtering=args.guided_filtering,
+    color_guide=args.color_guide,
     lambd=args.lambd,
     t0=args.t0,
     omega=args.omega,
     opaque=args.opaque,
+    atmospheric_light_method=args.atmospheric_light_method,
+    dtype=dtype,
+    cache=None if args.cache_dir is None else ArrayCache(args.cache_dir),
+    profiler=profiler,
+    num_threads=args.num_threads,
+    pyramid_size=args.resize if args.pyramid else None,
 )
 radiance, transmission, _ = haze_remover.remove_haze(args.gamma)
+if args.profile:
+    logging.info(profiler.profile.summary())
 
 
 extension = get_save_extension(args.soft_matting, args.guided_filtering, args.resize, file_extension)
-plt.imsave(save_folder + f"{name}_original.{file_extension}", image)
-plt.imsave(save_folder + f"{name}_radiance_{extension}", radiance)
-plt.imsave(save_folder + f"{name}_transmission_{extension}", transmission, cmap='gray')
+write_image(save_folder + f"{name}_original.{file_extension}", image)
+write_image(save_folder + f"{name}_radiance_{extension}", radiance)
+write_image(save_folder + f"{name}_transmission_{extension}", transmission)
@@ -0,0 +1,46 @@
+# python serve.py --port 8000 --workers 2 -f
+# curl --data-binary @images/img.jpg "http://127.0.0.1:8000/dehaze?t0=0.1" -o radiance.png
+# curl http://127.0.0.1:8000/stats
+
+import logging
+import argparse
+from haze_removal import LAMBDA, T0, OMEGA, OPAQUE, GAMMA, PATCH_SIZE
+from haze_removal.server import DehazingServer
+
+parser = argparse.ArgumentParser(description="Haze removal HTTP service")
+parser.add_argument("--host", type=str, default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8000)
+parser.add_argument("--workers", "-w", type=int, help="Number of worker processes (defaults to the number of CPUs)", default=None)
+parser.add_argument("--max_batch_size", type=int, help="Maximal number of requests of a batch", default=4)
+parser.add_argument("--max_delay", type=float, help="Maximal time (in seconds) a request waits for a batch to fill", default=0.01)
+parser.add_argument("--request_timeout", type=float, help="Time (in seconds) after which a request gets a 503 response", default=60)
+parser.add_argument("--patch_size", type=int, help="Patch size for dark channel extraction", default=PATCH_SIZE)
+parser.add_argument("--lambd", type=float, default=LAMBDA)
+parser.add_argument("--t0", type=float, default=T0)
+parser.add_argument("--omega", type=float, default=OMEGA)
+parser.add_argument("--opaque", type=float, default=OPAQUE)
+parser.add_argument("--gamma", type=float, default=GAMMA)
+parser.add_argument("--soft_matting", "-m", action='store_true', help="Boolean to use soft matting")
+parser.add_argument("--guided_filtering", "-f", action='store_true', help="Boolean to use guided filtering")
+parser.add_argument("--color_guide", action='store_true', help="Boolean to use the color image as guide for guided filtering")
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+server = DehazingServer(
+    workers=args.workers,
+    max_batch_size=args.max_batch_size,
+    max_delay=args.max_delay,
+    request_timeout=args.request_timeout,
+    patch_size=args.patch_size,
+    use_soft_matting=args.soft_matting,
+    guided_image_filtering=args.guided_filtering,
+    color_guide=args.color_guide,
+    lambd=args.lambd,
+    t0=args.t0,
+    omega=args.omega,
+    opaque=args.opaque,
+    gamma=args.gamma,
+)
+server.serve(args.host, args.port)